@@ -1,4 +1,6 @@
-from typing import List
+from typing import List, TextIO
+
+TSV_HEADERS = 'ObservationID\tText\tHPO Term\tSpans\n'
 
 class Term:
     def __init__(self, hpo_id: str, preferred_term: str, polarity: bool, spans: List[str], text: str):
@@ -129,6 +131,27 @@ class Observation:
     
     def copy_id(self, observation: 'Observation'):
         self.observation_id = observation.observation_id
+    
+    # Writes the prediction rows of the observation, one per valid term or a single NA row
+    def write_to_tsv(self, outfile: TextIO):
+        past_spans = []
+        terms = self.get_valid_terms()
+        if len(terms) != len(self.terms):
+            for term in self.terms:
+                if term not in terms and term.hpo_id is not None:
+                    print('Error: Invalid term present in observation: %s' % self.text)
+                    print('\t', term.get_preferred_term())
+        if len(terms) == 0:
+            outfile.write('%s\t%s\tNA\tNA\n' % (self.observation_id, self.text))
+        else:
+            for term in terms:
+                spans = ','.join(term.spans)
+                if spans not in past_spans:
+                    outfile.write('%s\t%s\t%s\t%s\n' % (self.observation_id, self.text,
+                                                       term.hpo_id, spans))
+                    past_spans.append(spans)
+                else:
+                    print('Error: Multiple concepts for single span for observation: %s' % self.text)
         
 class Dataset:
     def __init__(self, observations: List[str] = []):
@@ -201,26 +224,9 @@ class Dataset:
     
     def write_to_tsv(self, filename: str):
         with open(filename, 'w') as outfile:
-            outfile.write('ObservationID\tText\tHPO Term\tSpans\n')
+            outfile.write(TSV_HEADERS)
             for observation in self.observations:
-                past_spans = []
-                terms = observation.get_valid_terms()
-                if len(terms) != len(observation.terms):
-                    for term in observation.terms:
-                        if term not in terms and term.hpo_id is not None:
-                            print('Error: Invalid term present in observation: %s' % observation.text)
-                            print('\t', term.get_preferred_term())
-                if len(terms) == 0:
-                    outfile.write('%s\t%s\tNA\tNA\n' % (observation.observation_id, observation.text))
-                else:
-                    for term in terms:
-                        spans = ','.join(term.spans)
-                        if spans not in past_spans:
-                            outfile.write('%s\t%s\t%s\t%s\n' % (observation.observation_id, observation.text,
-                                                               term.hpo_id, spans))
-                            past_spans.append(spans)
-                        else:
-                            print('Error: Multiple concepts for single span for observation: %s' % observation.text)
+                observation.write_to_tsv(outfile)
     
     def write(self, filename: str):
         with open(filename, 'w') as outfile:
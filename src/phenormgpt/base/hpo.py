@@ -29,6 +29,12 @@ class Concept:
             terms.extend(self.synonyms)
         
         return terms
+    
+    # Term lists are copied too, so HPOs sharing a concept don't see each other's changes
+    def copy(self) -> 'Concept':
+        terms = [list(terms) if terms is not None else None
+                 for terms in [self.preferred_terms, self.synonyms, self.hierarchies]]
+        return Concept(self.hpo_id, self.preferred_term, *terms)
             
     
     def __str__(self, simplified: bool = True) -> str:
@@ -49,6 +55,11 @@ class Concept:
 class HPO:
     def __init__(self):
         self.concepts = {}
+        # Lowercase term -> HPO IDs of concepts with that term, in insertion order
+        self.term_index = {}
+        self.concept_terms = {}
+        self.concept_order = {}
+        self.num_added = 0
     
     def get_hpo_ids(self) -> List[str]:
         return list(self.concepts.keys())
@@ -56,8 +67,25 @@ class HPO:
     def get_concepts(self) -> List[Concept]:
         return list(self.concepts.values())
     
+    def has_concept(self, hpo_id: str) -> bool:
+        return hpo_id in self.concepts
+    
+    # Term index needs to be refreshed whenever terms of a concept change
+    def index_concept(self, concept: Concept):
+        self.unindex_concept(concept.hpo_id)
+        terms = list(dict.fromkeys([term.lower() for term in concept.get_all_terms()]))
+        for term in terms:
+            self.term_index.setdefault(term, {})[concept.hpo_id] = None
+        self.concept_terms[concept.hpo_id] = terms
+    
+    def unindex_concept(self, hpo_id: str):
+        for term in self.concept_terms.pop(hpo_id, []):
+            self.term_index[term].pop(hpo_id, None)
+            if len(self.term_index[term]) == 0:
+                self.term_index.pop(term)
+    
     def add_concept(self, concept: Concept):
-        if concept.hpo_id in self.get_hpo_ids():
+        if concept.hpo_id in self.concepts:
             # Overwrite concepts where applicable
             if concept.preferred_term is not None and len(concept.preferred_term) > 0:
                 self.concepts[concept.hpo_id].preferred_term = concept.preferred_term
@@ -69,18 +97,27 @@ class HPO:
                 self.concepts[concept.hpo_id].hierarchies = concept.hierarchies
         else:
             # Add a new concept
-            self.concepts[concept.hpo_id] = concept        
+            self.concepts[concept.hpo_id] = concept
+            self.concept_order[concept.hpo_id] = self.num_added
+            self.num_added += 1
+        self.index_concept(self.concepts[concept.hpo_id])
+    
+    def remove_concept(self, hpo_id: str):
+        if hpo_id in self.concepts:
+            self.concepts.pop(hpo_id)
+            self.concept_order.pop(hpo_id)
+            self.unindex_concept(hpo_id)
     
-    # Merge two HPOs, used to initiate from multiple files
+    # Merge two HPOs, used to initiate from multiple files.
+    # Concepts are copied, since adding a concept again changes it in place.
     def merge(self, hpo):
         for concept in hpo.get_concepts():
-            self.add_concept(concept)
+            self.add_concept(concept.copy())
     
     # Subtract one HPO from another, used to apply exclusion files
     def subtract(self, hpo):
         for hpo_id in hpo.get_hpo_ids():
-            if hpo_id in self.concepts.keys():
-                self.concepts.pop(hpo_id)
+            self.remove_concept(hpo_id)
     
     # Only returns concepts that include given aui in their hierarchy
     def filter_auis(self, auis: List[str]):
@@ -90,7 +127,7 @@ class HPO:
             for hierarcy in concept.hierarchies:
                 for aui in auis:
                     if aui in hierarcy:
-                        filtered_hpo.add_concept(concept)
+                        filtered_hpo.add_concept(concept.copy())
                         added = True
                         break
                 if added:
@@ -99,22 +136,22 @@ class HPO:
         return filtered_hpo
     
     def get_concept_by_hpo_id(self, hpo_id: str) -> Concept:
-        if hpo_id in self.get_hpo_ids():
-            return self.concepts[hpo_id]
-        return None
+        return self.concepts.get(hpo_id)
     
     def get_concepts_by_hpo_ids(self, hpo_ids: List[str]) -> List[Concept]:
-        concepts = []
-        for hpo_id in hpo_ids:
-            concepts += self.get_concept_by_hpo_id(hpo_id)
-        
+        concepts = [self.concepts.get(hpo_id) for hpo_id in hpo_ids]
         return [concept for concept in concepts if concept is not None]
     
+    def find_concepts_by_term(self, term: str) -> List[Concept]:
+        hpo_ids = sorted(self.term_index.get(term.lower(), {}), key=self.concept_order.get)
+        return [self.concepts[hpo_id] for hpo_id in hpo_ids]
+    
+    # Returns the first concept having the term, in concept order
     def find_concept_by_term(self, term: str) -> Concept:
-        for concept in self.get_concepts():
-            if term.lower() in [term_.lower() for term_ in concept.get_all_terms()]:
-                return concept
-        return None
+        hpo_ids = self.term_index.get(term.lower())
+        if not hpo_ids:
+            return None
+        return self.concepts[min(hpo_ids, key=self.concept_order.get)]
 
     def __str__(self, include_headers: bool = True, simplified: bool = True) -> str:
         hpo_str = ''
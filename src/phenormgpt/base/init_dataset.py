@@ -1,10 +1,11 @@
-import json
+from typing import Iterator
 
 from base.dataset import Dataset, Observation, Term
-from base.load_hpo import hpo
-from prompting.prompts import ASSISTANT_MESSAGE_TABLE_HEADER, EMPTY_RESPONSE_MESSAGE
+from base.load_hpo import get_hpo
+from base.response_parser import ResponseParser
 
 def init_dataset_from_file(observations_filepath: str, key_obs_only: bool = True) -> Dataset:
+    hpo = get_hpo()
     dataset = Dataset()
     dataset.observations = []
 
@@ -48,67 +49,62 @@ def init_dataset_from_file(observations_filepath: str, key_obs_only: bool = True
         dataset.add_observation(observation)
         return dataset
 
-def init_dataset_from_file_no_terms(observations_filepath: str) -> 'Dataset':
+# Reads predictions written by Dataset.write_to_tsv
+def init_dataset_from_predictions_file(predictions_filepath: str) -> Dataset:
+    hpo = get_hpo()
     dataset = Dataset()
     dataset.observations = []
+    observations = {}
+    
+    with open(predictions_filepath, 'r', encoding='utf-8') as predictions_file:
+        headers = predictions_file.readline().replace('\n', '')
+        line = predictions_file.readline().replace('\n', '')
+        while line:
+            observation_id, text, hpo_id, spans = line.split('\t')
+            if observation_id not in observations:
+                bodyloc = text.split(':')[0]
+                observations[observation_id] = Observation(observation_id, text, bodyloc)
+                dataset.add_observation(observations[observation_id])
+            if hpo_id != 'NA':
+                hpo_concept = hpo.get_concept_by_hpo_id(hpo_id)
+                preferred_term = hpo_concept.preferred_term if hpo_concept is not None else None
+                observations[observation_id].add_term(Term(hpo_id, preferred_term, False, spans.split(','), text))
+            line = predictions_file.readline().replace('\n', '')
     
+    return dataset
+
+# Reads observations one line at a time
+def iter_observations_from_file_no_terms(observations_filepath: str) -> Iterator[Observation]:
     with open(observations_filepath, 'r', encoding='utf-8') as observations_file:
         headers = observations_file.readline().replace('\n', '')
         line = observations_file.readline().replace('\n', '')
         while line:
             observation_id, text = line.split('\t')
             bodyloc = text.split(':')[0]
-            observation = Observation(observation_id, text, bodyloc)
-            dataset.add_observation(observation)
+            yield Observation(observation_id, text, bodyloc)
             line = observations_file.readline().replace('\n', '')
+
+def init_dataset_from_file_no_terms(observations_filepath: str) -> 'Dataset':
+    dataset = Dataset()
+    dataset.observations = []
+    
+    for observation in iter_observations_from_file_no_terms(observations_filepath):
+        dataset.add_observation(observation)
             
     return dataset
 
-# Initialize dataset from a JSON including observations and extracted concepts.
+# Initialize dataset from a JSON list or JSONL file including observations and extracted concepts.
+# Responses are read one at a time, rows that can't be parsed are logged to reject_log_filepath when given.
 # Must pass in a matcher function to normalize the extracted concepts.
-def init_dataset_from_openai_responses(responses_filepath: str) -> Dataset:
+def init_dataset_from_openai_responses(responses_filepath: str, reject_log_filepath: str = None) -> Dataset:
     dataset = Dataset()
     dataset.observations = []
     
-    responses_dict = json.loads(open(responses_filepath, 'r').read())
-    for item in responses_dict:
-        
-        # Create observation
-        text = item['observation']
-        bodyloc = text.split(':')[0]
-        observation = Observation(None, text, bodyloc)
-        
-        # Create terms
-        response = item['response']
-        
-        # Parse response
-        if response != EMPTY_RESPONSE_MESSAGE: # Skip if there are no concepts
-            term_lines = response.split('\n')[ASSISTANT_MESSAGE_TABLE_HEADER.count('\n') + 1:] # Skip table headers
-            for line in term_lines:
-                try:
-                    _, preferred_term, tagged_text, _ = line.split('|')
-                except ValueError as e:
-                    print('Error: Can\'t parse line: %s' % line)
-                    raise e
-                preferred_term = preferred_term.strip()
-                tagged_text = tagged_text.strip()
-                
-                # Calculate Spans
-                spans = []
-                start_indices = [i for i in range(len(tagged_text)) if tagged_text.startswith('[', i)]
-                end_indices = [i for i in range(len(tagged_text)) if tagged_text.startswith(']', i)]
-
-                if len(start_indices) != len(end_indices):
-                    print('Error parsing extracted term line: %s. Uneven tagging.' % preferred_term)
-
-                # Calculate spans from tagged_text, accounting index shifts.
-                for i in range(len(start_indices)):
-                    span = '%d-%d' % (start_indices[i] - (2 * i), end_indices[i] - ((2 * i) + 1))
-                    spans.append(span)
-                
-                term = Term(None, preferred_term, False, spans, text)
-                observation.add_term(term)
-        
+    response_parser = ResponseParser(reject_log_filepath)
+    for observation in response_parser.iter_observations(responses_filepath):
         dataset.add_observation(observation)
+    response_parser.close()
+    if response_parser.counts['rejected_rows'] > 0:
+        response_parser.print_counts()
         
     return dataset
\ No newline at end of file
@@ -40,12 +40,13 @@ def load_merged_dataset() -> Dataset:
     merged_dataset.observations.extend(load_test_dataset().observations)
     return merged_dataset
 
-def load_handpicked_dataset() -> Dataset:
+# Handpicked observations are picked from the annotated dataset by default
+def load_handpicked_dataset(handpicked_filepath: str = HANDPICKED_FILEPATH, annotated_dataset: Dataset = None) -> Dataset:
     handpicked_dataset = Dataset([])
     handpicked_dataset.observations = []
     
     handpicked_observation_ids = []
-    with open(HANDPICKED_FILEPATH, 'r') as f:
+    with open(handpicked_filepath, 'r') as f:
         headers = f.readline()
         line = f.readline().replace('\n', '')
         while line:
@@ -55,7 +56,8 @@ def load_handpicked_dataset() -> Dataset:
                     handpicked_observation_ids.append(line_observation_id)
             line = f.readline().replace('\n', '')
     
-    annotated_dataset = load_annotated_dataset()
+    if annotated_dataset is None:
+        annotated_dataset = load_annotated_dataset()
     for observation in annotated_dataset.observations:
         if observation.observation_id in handpicked_observation_ids:
             handpicked_dataset.add_observation(observation)
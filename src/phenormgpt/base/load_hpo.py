@@ -50,4 +50,13 @@ def load_hpo_instance() -> HPO:
         ]
     )
 
-hpo = load_hpo_instance()
\ No newline at end of file
+# The HPO instance is served from the compiled lexicon snapshot, see matching.lexicon.
+# Loaded on first access, since building the snapshot uses load_hpo_instance.
+def get_hpo() -> HPO:
+    from matching.lexicon import get_lexicon
+    return get_lexicon().hpo
+
+def __getattr__(name: str):
+    if name == 'hpo':
+        return get_hpo()
+    raise AttributeError('module %s has no attribute %s' % (__name__, name))
\ No newline at end of file
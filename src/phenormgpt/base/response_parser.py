@@ -0,0 +1,156 @@
+# Incremental parsing of model responses into observations.
+# Responses are read one item at a time from JSON lists or JSONL files, and malformed
+# table rows are counted and logged instead of stopping the run.
+
+import json
+import re
+import threading
+from typing import Iterator, List, TextIO, Tuple
+
+from base.dataset import Observation, Term
+from prompting.prompts import ASSISTANT_MESSAGE_TABLE_HEADER, EMPTY_RESPONSE_MESSAGE
+
+RE_TAG = re.compile(r'[\[\]]')
+
+# Spans of the bracketed parts of a tagged text, in one scan.
+# Every bracket shifts the following text by one, so spans are corrected by the brackets seen so far.
+# Returns None for unbalanced or nested brackets.
+def get_tagged_spans(tagged_text: str) -> List[str]:
+    spans = []
+    begin = None
+    shift = 0
+    for tag in RE_TAG.finditer(tagged_text):
+        index = tag.start()
+        if tag.group() == '[':
+            if begin is not None:
+                return None
+            begin = index - shift
+        else:
+            if begin is None:
+                return None
+            spans.append('%d-%d' % (begin, index - shift))
+            begin = None
+        shift += 1
+    if begin is not None:
+        return None
+    return spans
+
+# Yields the items of a JSON list without loading the whole file
+def iter_json_list(file: TextIO, chunk_size: int = 1 << 16) -> Iterator:
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    eof = False
+    started = False
+    while True:
+        # Skip separators
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+        item = None
+        end = None
+        if position < len(buffer):
+            if not started:
+                if buffer[position] != '[':
+                    raise ValueError('Expected a JSON list.')
+                started = True
+                position += 1
+                continue
+            if buffer[position] == ']':
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                end = None
+        # Items ending at the end of the buffer, e.g. numbers, may continue in the next chunk
+        if end is None or (end == len(buffer) and not eof):
+            if eof:
+                raise ValueError('Truncated JSON list.')
+            chunk = file.read(chunk_size)
+            eof = len(chunk) == 0
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        yield item
+        position = end
+
+# Yields {observation, response} items from a JSON list or a JSONL file
+def iter_response_items(responses_filepath: str) -> Iterator[dict]:
+    with open(responses_filepath, 'r', encoding='utf-8') as file:
+        first_character = ''
+        while first_character in ['', ' ', '\t', '\r', '\n']:
+            first_character = file.read(1)
+            if first_character == '':
+                return
+        file.seek(0)
+        if first_character == '[':
+            yield from iter_json_list(file)
+        else:
+            for line in file:
+                if len(line.strip()) > 0:
+                    yield json.loads(line)
+
+class ResponseParser:
+    def __init__(self, reject_log_filepath: str = None):
+        self.counts = {'observations': 0, 'terms': 0, 'rejected_rows': 0}
+        # Rejected rows by reason
+        self.rejections = {}
+        self.reject_log = open(reject_log_filepath, 'w', encoding='utf-8') if reject_log_filepath is not None else None
+        self.lock = threading.Lock()
+
+    def reject(self, text: str, line: str, reason: str):
+        with self.lock:
+            self.counts['rejected_rows'] += 1
+            self.rejections[reason] = self.rejections.get(reason, 0) + 1
+            if self.reject_log is not None:
+                self.reject_log.write(json.dumps({'observation': text, 'line': line, 'reason': reason}) + '\n')
+                self.reject_log.flush()
+
+    # Term of a table row, or None if the row is rejected
+    def parse_line(self, text: str, line: str) -> Term:
+        columns = line.split('|')
+        if len(columns) != 4:
+            self.reject(text, line, 'Malformed row')
+            return None
+        preferred_term = columns[1].strip()
+        spans = get_tagged_spans(columns[2].strip())
+        if spans is None:
+            self.reject(text, line, 'Uneven tagging')
+            return None
+        return Term(None, preferred_term, False, spans, text)
+
+    # Observation with the terms extracted in a response, terms aren't normalized yet.
+    def parse(self, text: str, response: str) -> Observation:
+        bodyloc = text.split(':')[0]
+        observation = Observation(None, text, bodyloc)
+
+        if response != EMPTY_RESPONSE_MESSAGE: # Skip if there are no concepts
+            term_lines = response.split('\n')[ASSISTANT_MESSAGE_TABLE_HEADER.count('\n') + 1:] # Skip table headers
+            for line in term_lines:
+                term = self.parse_line(text, line)
+                if term is not None:
+                    observation.add_term(term)
+
+        with self.lock:
+            self.counts['observations'] += 1
+            self.counts['terms'] += len(observation.terms)
+        return observation
+
+    # Parses observations one at a time, e.g. to normalize them as they are read
+    def iter_observations(self, responses_filepath: str) -> Iterator[Observation]:
+        for item in iter_response_items(responses_filepath):
+            yield self.parse(item['observation'], item['response'])
+
+    def get_rejections(self) -> List[Tuple[str, int]]:
+        with self.lock:
+            return list(self.rejections.items())
+
+    def print_counts(self):
+        print('Parsed %d observations with %d terms, rejected %d rows.' % \
+              (self.counts['observations'], self.counts['terms'], self.counts['rejected_rows']))
+        for reason, count in self.get_rejections():
+            print('\t%s: %d' % (reason, count))
+
+    def close(self):
+        if self.reject_log is not None:
+            self.reject_log.close()
+            self.reject_log = None
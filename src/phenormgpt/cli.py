@@ -0,0 +1,215 @@
+# Command line interface for scheduled runs, e.g. python cli.py infer --help
+# Resources and default paths in config.config are found under --base-dir.
+# Modules are imported within commands, after --base-dir is applied.
+
+import os
+import time
+import click
+
+from util.timing import StageTimer
+
+@click.group()
+@click.option('--base-dir', type=click.Path(exists=True, file_okay=False), default=None,
+              help='Repository root holding data, output and resources. Defaults to config.config.BASE_DIR.')
+def cli(base_dir: str):
+    if base_dir is not None:
+        os.environ['PHENORMGPT_BASE_DIR'] = base_dir
+
+def print_timing_summary(timer: StageTimer, start_time: float):
+    timer.print_summary()
+    print('Total: %.2f seconds.' % (time.perf_counter() - start_time))
+
+def load_annotated_datasets(filepaths: list):
+    from base.dataset import Dataset
+    from base.init_dataset import init_dataset_from_file
+    dataset = Dataset([])
+    dataset.observations = []
+    for filepath in filepaths:
+        dataset.observations.extend(init_dataset_from_file(filepath).observations)
+    return dataset
+
+@cli.command()
+@click.option('--input', 'input_filepath', type=click.Path(exists=True, dir_okay=False), required=True,
+              help='TSV of observations to annotate, with ObservationID and Text columns.')
+@click.option('--output', 'output_filepath', type=click.Path(dir_okay=False), required=True,
+              help='TSV to write predictions to.')
+@click.option('--few-shot', 'few_shot_filepaths', type=click.Path(exists=True, dir_okay=False), multiple=True,
+              help='Annotated TSV to pick few shot examples from, can be repeated.')
+@click.option('--handpicked', 'handpicked_filepath', type=click.Path(exists=True, dir_okay=False), default=None,
+              help='Handpicked example IDs, picked from the few shot datasets.')
+@click.option('--few-shot-k', type=int, default=10, show_default=True)
+@click.option('--few-shot-k-min', type=int, default=3, show_default=True)
+@click.option('--max-prompt-tokens', type=int, default=None, help='Token budget for few shot examples.')
+@click.option('--prefix-stable', is_flag=True, help='Order examples so prompts share prefixes.')
+@click.option('--seed', type=int, default=0, show_default=True, help='Seed for the order of examples.')
+@click.option('--model', default='gpt-3.5-turbo-0613', show_default=True)
+@click.option('--api-key', default=None, help='Defaults to config.openai_config.')
+@click.option('--api-base', default=None, help='OpenAI compatible API base URL.')
+@click.option('--max-concurrency', type=int, default=8, show_default=True, help='Requests in flight.')
+@click.option('--queue-size', type=int, default=64, show_default=True, help='Items buffered between stages.')
+@click.option('--response-cache', 'response_cache_filepath', type=click.Path(dir_okay=False), default=None,
+              help='SQLite response cache. Defaults to the cache directory.')
+@click.option('--no-response-cache', is_flag=True, help='Send every request, even if cached.')
+@click.option('--no-normalize', is_flag=True, help='Write predictions without HPO IDs.')
+@click.option('--reject-log', 'reject_log_filepath', type=click.Path(dir_okay=False), default=None,
+              help='JSONL file to log response rows that can\'t be parsed.')
+@click.option('--normalization-cache', 'normalization_cache_filepath', type=click.Path(dir_okay=False), default=None,
+              help='SQLite normalization cache. Defaults to the cache directory.')
+@click.option('--no-normalization-cache', is_flag=True, help='Match every term, even if cached.')
+@click.option('--emb-matching', is_flag=True, help='Match terms no other matcher could with word vectors.')
+@click.option('--pretag', is_flag=True, help='Tag observations explained by dictionary terms without a request.')
+@click.option('--pretag-min-coverage', type=click.FloatRange(0, 1), default=1.0, show_default=True,
+              help='Share of words that must be tagged to skip the request.')
+def infer(input_filepath: str, output_filepath: str, few_shot_filepaths: tuple, handpicked_filepath: str,
+          few_shot_k: int, few_shot_k_min: int, max_prompt_tokens: int, prefix_stable: bool, seed: int, model: str,
+          api_key: str, api_base: str, max_concurrency: int, queue_size: int, response_cache_filepath: str,
+          no_response_cache: bool, no_normalize: bool, reject_log_filepath: str, normalization_cache_filepath: str,
+          no_normalization_cache: bool, emb_matching: bool, pretag: bool, pretag_min_coverage: float):
+    """Extract and normalize HPO terms with an OpenAI model."""
+    start_time = time.perf_counter()
+    timer = StageTimer()
+    with timer.measure('load'):
+        from base.init_dataset import iter_observations_from_file_no_terms
+        from base.load_dataset import load_handpicked_dataset
+        from base.load_hpo import get_hpo
+        import matching.normalization
+        from matching.normalization import get_normalization_cache
+        from matching.pretagger import PretagPolicy
+        from pipeline.streaming import run_pipeline
+        from prompting.openai_client import OpenAIClient, get_response_cache
+        from prompting.prompts import SYSTEM_MESSAGE, USER_MESSAGE_WRAPPER, ASSISTANT_MESSAGE_TABLE_HEADER
+        if api_key is None:
+            from config.openai_config import openai_api_key
+            api_key = openai_api_key
+
+        hpo = get_hpo()
+        few_shot_dataset = None
+        hand_picked_dataset = None
+        if len(few_shot_filepaths) > 0:
+            few_shot_dataset = load_annotated_datasets(few_shot_filepaths)
+            if handpicked_filepath is not None:
+                hand_picked_dataset = load_handpicked_dataset(handpicked_filepath, few_shot_dataset)
+        response_cache = None
+        if not no_response_cache:
+            response_cache = get_response_cache(filepath=response_cache_filepath)
+        openai_client = OpenAIClient(api_key, model=model, debug=False, api_base=api_base,
+                                     response_cache=response_cache)
+        matching.normalization.USE_EMB_MATCHING = emb_matching
+        normalization_cache = None
+        if not no_normalize and not no_normalization_cache:
+            normalization_cache = get_normalization_cache(filepath=normalization_cache_filepath)
+        pretag_policy = PretagPolicy(min_coverage=pretag_min_coverage) if pretag else None
+
+    stats = run_pipeline(iter_observations_from_file_no_terms(input_filepath), output_filepath, openai_client, hpo,
+                         few_shot_dataset, max_concurrency, queue_size, not no_normalize, timer, reject_log_filepath,
+                         normalization_cache, pretag_policy,
+                         system_message=SYSTEM_MESSAGE, user_message_wrapper=USER_MESSAGE_WRAPPER,
+                         assistant_message_table_header=ASSISTANT_MESSAGE_TABLE_HEADER, few_shot_k=few_shot_k,
+                         few_shot_k_min=few_shot_k_min, hand_picked_dataset=hand_picked_dataset,
+                         max_prompt_tokens=max_prompt_tokens, prefix_stable=prefix_stable, seed=seed)
+    if response_cache is not None:
+        print('Response cache: %d hits, %d misses.' % (response_cache.hits, response_cache.misses))
+        response_cache.close()
+    if normalization_cache is not None:
+        normalization_cache.print_stats()
+        normalization_cache.close()
+    openai_client.print_utilisation()
+    print_timing_summary(timer, start_time)
+
+@cli.command('build-finetune')
+@click.option('--input', 'input_filepaths', type=click.Path(exists=True, dir_okay=False), multiple=True, required=True,
+              help='Annotated TSV, can be repeated.')
+@click.option('--output', 'output_filepath', type=click.Path(dir_okay=False), required=True,
+              help='JSONL file to write fine-tuning messages to.')
+def build_finetune(input_filepaths: tuple, output_filepath: str):
+    """Write fine-tuning messages for annotated datasets."""
+    start_time = time.perf_counter()
+    timer = StageTimer()
+    with timer.measure('load'):
+        from base.load_hpo import get_hpo
+        from prompting.generate_messages import get_openai_finetuning_messages
+        from prompting.openai_dataset_analysis import save_to_jsonl
+        from prompting.prompts import SYSTEM_MESSAGE, USER_MESSAGE_WRAPPER, ASSISTANT_MESSAGE_TABLE_HEADER
+        hpo = get_hpo()
+        dataset = load_annotated_datasets(input_filepaths)
+
+    with timer.measure('messages'):
+        messages = get_openai_finetuning_messages(dataset, hpo=hpo, system_message=SYSTEM_MESSAGE,
+                                                  user_message_wrapper=USER_MESSAGE_WRAPPER,
+                                                  assistant_message_table_header=ASSISTANT_MESSAGE_TABLE_HEADER)
+    with timer.measure('write'):
+        save_to_jsonl(messages, output_filepath)
+    print('Wrote %d fine-tuning examples to %s.' % (len(messages), output_filepath))
+    print_timing_summary(timer, start_time)
+
+@cli.command()
+@click.option('--input', 'input_filepath', type=click.Path(exists=True, dir_okay=False), required=True,
+              help='JSON list or JSONL file of {observation, response} items.')
+@click.option('--output', 'output_filepath', type=click.Path(dir_okay=False), required=True,
+              help='TSV to write predictions to.')
+@click.option('--observations', 'observations_filepath', type=click.Path(exists=True, dir_okay=False), default=None,
+              help='TSV of the observations the responses are for, in the same order, to copy their IDs.')
+@click.option('--reject-log', 'reject_log_filepath', type=click.Path(dir_okay=False), default=None,
+              help='JSONL file to log response rows that can\'t be parsed.')
+@click.option('--normalization-cache', 'normalization_cache_filepath', type=click.Path(dir_okay=False), default=None,
+              help='SQLite normalization cache. Defaults to the cache directory.')
+@click.option('--no-normalization-cache', is_flag=True, help='Match every term, even if cached.')
+@click.option('--emb-matching', is_flag=True, help='Match terms no other matcher could with word vectors.')
+def normalize(input_filepath: str, output_filepath: str, observations_filepath: str, reject_log_filepath: str,
+              normalization_cache_filepath: str, no_normalization_cache: bool, emb_matching: bool):
+    """Normalize terms of saved responses to HPO IDs."""
+    start_time = time.perf_counter()
+    timer = StageTimer()
+    with timer.measure('load'):
+        from base.init_dataset import init_dataset_from_file_no_terms, init_dataset_from_openai_responses
+        from matching.lexicon import get_lexicon
+        import matching.normalization
+        from matching.normalization import get_normalization_cache, normalize_dataset
+        get_lexicon()
+        matching.normalization.USE_EMB_MATCHING = emb_matching
+        normalization_cache = None
+        if not no_normalization_cache:
+            normalization_cache = get_normalization_cache(filepath=normalization_cache_filepath)
+        response_dataset = init_dataset_from_openai_responses(input_filepath, reject_log_filepath)
+        if observations_filepath is not None:
+            response_dataset.copy_observation_ids(init_dataset_from_file_no_terms(observations_filepath))
+
+    with timer.measure('normalize'):
+        normalize_dataset(response_dataset, normalization_cache=normalization_cache)
+    with timer.measure('write'):
+        response_dataset.write_to_tsv(output_filepath)
+    print('Wrote predictions for %d observations to %s.' % (len(response_dataset.observations), output_filepath))
+    if normalization_cache is not None:
+        normalization_cache.print_stats()
+        normalization_cache.close()
+    print_timing_summary(timer, start_time)
+
+@cli.command()
+@click.option('--gold', 'gold_filepath', type=click.Path(exists=True, dir_okay=False), required=True,
+              help='Annotated TSV.')
+@click.option('--pred', 'pred_filepath', type=click.Path(exists=True, dir_okay=False), required=True,
+              help='Predictions TSV, as written by infer or normalize.')
+@click.option('--overlap', is_flag=True, help='Count overlapping spans as matches, instead of exact spans.')
+def evaluate(gold_filepath: str, pred_filepath: str, overlap: bool):
+    """Score predictions against annotations."""
+    start_time = time.perf_counter()
+    timer = StageTimer()
+    with timer.measure('load'):
+        from base.dataset import Dataset
+        from base.init_dataset import init_dataset_from_file, init_dataset_from_predictions_file
+        from matching.eval import compare
+        from matching.normalization import match
+        gold_dataset = init_dataset_from_file(gold_filepath)
+        pred_observations = {observation.observation_id: observation \
+                             for observation in init_dataset_from_predictions_file(pred_filepath).observations}
+
+    # Observations without predictions count as predicting nothing
+    pred_dataset = Dataset([pred_observations.get(observation.observation_id, observation.get_observation_text()) \
+                            for observation in gold_dataset.observations])
+    with timer.measure('evaluate'):
+        precision, recall, f1 = compare(gold_dataset, pred_dataset, match, cui_check=True, span_check=not overlap)
+    print('Precision: %.4f, Recall: %.4f, F1: %.4f' % (precision, recall, f1))
+    print_timing_summary(timer, start_time)
+
+if __name__ == '__main__':
+    cli()
@@ -1,6 +1,8 @@
+from os import environ
 from os.path import join
 
-BASE_DIR = '../../../'
+# Relative to the notebook directory by default
+BASE_DIR = environ.get('PHENORMGPT_BASE_DIR', '../../../')
 DATA_DIR = join(BASE_DIR, 'data')
 OUTPUT_DIR = join(BASE_DIR, 'output')
 RESOURCES_DIR = join(BASE_DIR, 'src', 'resources')
@@ -1 +1,6 @@
-openai_api_key = 'ENTER_KEY_HERE'
\ No newline at end of file
+openai_api_key = 'ENTER_KEY_HERE'
+
+# Optional: Several API keys or deployments, requests are spread over their quotas.
+# Each entry holds arguments of prompting.openai_client.Endpoint, e.g.
+# {'api_key': 'ENTER_KEY_HERE', 'token_limit': 90_000, 'request_limit': 3_500}
+openai_endpoints = []
\ No newline at end of file
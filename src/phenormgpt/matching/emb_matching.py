@@ -0,0 +1,120 @@
+# Semantic matching with the spacy word vectors of prompting.similarity.
+# Every HPO preferred term and synonym is a row of a normalized float32 matrix, saved to the cache
+# and memory-mapped, so a batch of terms is matched with a single matrix product.
+
+import hashlib
+import json
+import os
+import numpy as np
+from typing import List, Tuple
+
+from base.hpo import HPO
+from config.config import CACHE_DIR
+from matching.lexicon import get_lexicon
+from prompting.similarity import get_model, get_text_vectors
+from util.lazy import LazyValue
+
+EMB_INDEX_DIR = os.path.join(CACHE_DIR, 'emb_index')
+# Minimum cosine similarity to accept a match
+EMB_THRESHOLD = 0.9
+
+# (HPO ID, term) for every preferred term and synonym, in concept order
+def get_hpo_term_rows(hpo: HPO) -> List[Tuple[str, str]]:
+    rows = []
+    for concept in hpo.get_concepts():
+        for term in dict.fromkeys(concept.get_all_terms()):
+            rows.append((concept.hpo_id, term))
+    return rows
+
+def get_emb_fingerprint(rows: List[Tuple[str, str]]) -> str:
+    meta = get_model().meta
+    fingerprint = hashlib.sha256(('%s-%s\n' % (meta.get('name'), meta.get('version'))).encode('utf-8'))
+    for hpo_id, term in rows:
+        fingerprint.update(('%s\t%s\n' % (hpo_id, term)).encode('utf-8'))
+    return fingerprint.hexdigest()
+
+class EmbeddingIndex:
+    def __init__(self, vectors: np.ndarray, hpo_ids: np.ndarray, fingerprint: str = None):
+        self.vectors = vectors # Row -> normalized term vector
+        self.hpo_ids = hpo_ids # Row -> HPO ID
+        self.fingerprint = fingerprint
+
+    @staticmethod
+    def build(rows: List[Tuple[str, str]]) -> 'EmbeddingIndex':
+        vectors = get_text_vectors([term for _, term in rows])
+        hpo_ids = np.array([hpo_id for hpo_id, _ in rows])
+        return EmbeddingIndex(vectors, hpo_ids, get_emb_fingerprint(rows))
+
+    # Returns the rows and scores of the k most similar terms for every query vector, best first.
+    # Terms sharing a vector tie, the best match is then the first row, i.e. the first concept.
+    # Scores are rounded so ties don't depend on rounding errors of the batch size.
+    # Queries are scored in batches, to bound the size of the score matrix.
+    def search(self, query_vectors: np.ndarray, k: int = 1, batch_size: int = 1024) -> Tuple[np.ndarray, np.ndarray]:
+        k = min(k, len(self.hpo_ids))
+        rows = np.zeros((len(query_vectors), k), dtype=np.int64)
+        scores = np.zeros((len(query_vectors), k), dtype=np.float32)
+        for start in range(0, len(query_vectors), batch_size):
+            batch_scores = np.round(query_vectors[start:start + batch_size] @ self.vectors.T, 5)
+            if k == 1:
+                top_rows = np.argmax(batch_scores, axis=1)[:, None]
+            else:
+                top_rows = np.argpartition(-batch_scores, k - 1, axis=1)[:, :k]
+            top_scores = np.take_along_axis(batch_scores, top_rows, axis=1)
+            order = np.lexsort((top_rows, -top_scores), axis=1)
+            rows[start:start + batch_size] = np.take_along_axis(top_rows, order, axis=1)
+            scores[start:start + batch_size] = np.take_along_axis(top_scores, order, axis=1)
+        return rows, scores
+
+    # Returns the HPO ID of the most similar term for every term, None below the threshold
+    def match_batch(self, terms: List[str], threshold: float = EMB_THRESHOLD) -> List[str]:
+        if len(terms) == 0 or len(self.hpo_ids) == 0:
+            return [None] * len(terms)
+        rows, scores = self.search(get_text_vectors(terms))
+        return [str(self.hpo_ids[row[0]]) if score[0] >= threshold else None for row, score in zip(rows, scores)]
+
+    def save(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, 'vectors.npy'), self.vectors)
+        np.save(os.path.join(directory, 'hpo_ids.npy'), self.hpo_ids)
+        with open(os.path.join(directory, 'index.json'), 'w') as file:
+            json.dump({'fingerprint': self.fingerprint}, file)
+
+    # Vectors are memory-mapped, returns None if the saved index doesn't belong to the fingerprint.
+    @staticmethod
+    def load(directory: str, fingerprint: str) -> 'EmbeddingIndex':
+        try:
+            with open(os.path.join(directory, 'index.json'), 'r') as file:
+                if json.load(file)['fingerprint'] != fingerprint:
+                    return None
+            vectors = np.load(os.path.join(directory, 'vectors.npy'), mmap_mode='r')
+            hpo_ids = np.load(os.path.join(directory, 'hpo_ids.npy'))
+        except (OSError, ValueError, KeyError):
+            return None
+        return EmbeddingIndex(vectors, hpo_ids, fingerprint)
+
+# Loads the index for the current HPO from disk, builds and saves it if there is none.
+def load_emb_index(directory: str = EMB_INDEX_DIR) -> EmbeddingIndex:
+    rows = get_hpo_term_rows(get_lexicon().hpo)
+    fingerprint = get_emb_fingerprint(rows)
+    index_directory = os.path.join(directory, fingerprint[:16])
+    emb_index = EmbeddingIndex.load(index_directory, fingerprint)
+    if emb_index is None:
+        print('Building embedding index for %d HPO terms...' % len(rows))
+        emb_index = EmbeddingIndex.build(rows)
+        emb_index.save(index_directory)
+    return emb_index
+
+lazy_emb_index = LazyValue(load_emb_index)
+
+def get_emb_index() -> EmbeddingIndex:
+    return lazy_emb_index.get()
+
+# Embedding Matching
+
+def match_emb(term: str) -> Tuple[str, str]:
+    return match_emb_batch([term])[0]
+
+# Matches many terms with one matrix product, e.g. every unmatched term of a dataset
+def match_emb_batch(terms: List[str]) -> List[Tuple[str, str]]:
+    hpo_ids = get_emb_index().match_batch(terms)
+    return [(hpo_id, 'Embedding matching') if hpo_id is not None else (None, None) for hpo_id in hpo_ids]
@@ -0,0 +1,81 @@
+import numpy as np
+from typing import List, Tuple
+
+from matching.dict_matching import get_stemmed_term_dict
+from util.lazy import LazyValue
+
+# Minimum Jaccard similarity of character trigrams to accept a match
+FUZZY_THRESHOLD = 0.75
+# Shorter terms have too few trigrams to tell apart typos from different words
+FUZZY_MIN_TRIGRAMS = 4
+
+# Trigrams of each token padded with spaces, so word boundaries count and word order doesn't
+def get_trigrams(term: str) -> List[str]:
+    trigrams = []
+    for token in term.split():
+        padded = ' %s ' % token
+        trigrams.extend([padded[i:i + 3] for i in range(len(padded) - 2)])
+    return list(dict.fromkeys(trigrams))
+
+# Inverted index from character trigrams to stemmed lexicon terms.
+# A lookup only touches the postings of the query's trigrams, whose counts give the
+# exact trigram Jaccard similarity of every candidate sharing at least one trigram.
+class FuzzyIndex:
+    def __init__(self, entries: dict, threshold: float = FUZZY_THRESHOLD, min_trigrams: int = FUZZY_MIN_TRIGRAMS):
+        self.terms = list(entries.keys())
+        self.hpo_ids = list(entries.values())
+        self.threshold = threshold
+        self.min_trigrams = min_trigrams
+
+        postings = {}
+        self.sizes = np.zeros(len(self.terms), dtype=np.int32)
+        for row, term in enumerate(self.terms):
+            trigrams = get_trigrams(term)
+            self.sizes[row] = len(trigrams)
+            for trigram in trigrams:
+                postings.setdefault(trigram, []).append(row)
+        self.postings = {trigram: np.array(rows, dtype=np.int32) for trigram, rows in postings.items()}
+
+    # Returns the row of the most similar term and its similarity, ties go to the term added first
+    def search(self, stemmed_term: str) -> Tuple[int, float]:
+        trigrams = get_trigrams(stemmed_term)
+        if len(trigrams) < self.min_trigrams:
+            return None, 0.0
+        rows = [self.postings[trigram] for trigram in trigrams if trigram in self.postings]
+        if len(rows) == 0:
+            return None, 0.0
+
+        # Shortlist candidates sharing enough trigrams to reach the threshold, |A ∩ B| >= threshold * |A|
+        shared = np.bincount(np.concatenate(rows), minlength=len(self.terms))
+        candidates = np.flatnonzero(shared >= self.threshold * len(trigrams))
+        shared = shared[candidates]
+        if len(candidates) == 0:
+            return None, 0.0
+
+        similarities = shared / (len(trigrams) + self.sizes[candidates] - shared)
+        best = np.argmax(similarities)
+        return int(candidates[best]), float(similarities[best])
+
+    # Returns the most similar term, its HPO ID and similarity, or Nones below the threshold
+    def match(self, stemmed_term: str) -> Tuple[str, str, float]:
+        row, similarity = self.search(stemmed_term)
+        if row is None or similarity < self.threshold:
+            return None, None, similarity
+        return self.terms[row], self.hpo_ids[row], similarity
+
+# Index over every stemmed dictionary term
+def build_fuzzy_index() -> FuzzyIndex:
+    return FuzzyIndex(get_stemmed_term_dict())
+
+lazy_fuzzy_index = LazyValue(build_fuzzy_index)
+
+def get_fuzzy_index() -> FuzzyIndex:
+    return lazy_fuzzy_index.get()
+
+# Fuzzy Matching
+
+def match_stemmed_fuzzy(stemmed_term: str) -> Tuple[str, str]:
+    _, hpo_id, _ = get_fuzzy_index().match(stemmed_term)
+    if hpo_id is not None:
+        return hpo_id, 'Fuzzy matching'
+    return None, None
@@ -0,0 +1,131 @@
+# Compiled lexicon snapshot: the HPO, the stemmed HPO dictionary and the observation dictionary.
+# Building it means parsing the HPO files and stemming every term, so the result is pickled
+# to the cache, keyed by the contents of the source files. It's only rebuilt when one changes.
+
+import glob
+import hashlib
+import json
+import os
+from typing import List
+
+from base.hpo import HPO
+from base.load_hpo import load_hpo_instance
+from config.config import HPO_JSON_FILEPATH, HPO_TERMS_FILEPATH, UNOBSERVABLE_HPO_TERMS_FILEPATH, \
+    OBSOLETE_HPO_TERMS_FILEPATH, OBSERVATION_DICT_FILEPATH
+from util.caching import CACHE_DIR, save_to_cache, load_from_cache
+from util.lazy import LazyValue
+from util.stemming import stem, stem_many
+
+# Bump when the snapshot contents or the stemming change
+LEXICON_VERSION = 1
+
+# Every file the lexicon is built from, see load_hpo_instance
+LEXICON_SOURCE_FILEPATHS = [
+    HPO_JSON_FILEPATH,
+    HPO_TERMS_FILEPATH,
+    UNOBSERVABLE_HPO_TERMS_FILEPATH,
+    OBSOLETE_HPO_TERMS_FILEPATH,
+    OBSERVATION_DICT_FILEPATH
+]
+
+class Lexicon:
+    def __init__(self, hpo: HPO, hpo_dict: dict, observation_dict: dict):
+        self.hpo = hpo
+        self.hpo_dict = hpo_dict
+        self.observation_dict = observation_dict
+
+def stem_term(term: str) -> str:
+    return stem(term, sort=False, lower=True, clean=True, stop_words=True)
+
+def stem_terms(terms: List[str], workers: int = None) -> List[str]:
+    return stem_many(terms, sort=False, lower=True, clean=True, stop_words=True, workers=workers)
+
+def load_observation_dict(filepath: str = OBSERVATION_DICT_FILEPATH) -> dict:
+    with open(filepath, 'r') as file:
+        return json.load(file)
+
+def get_stemmed_hpo_dict(hpo: HPO, observation_dict: dict = None, workers: int = None) -> dict:
+    print('Building HPO dict for matching...')
+    if observation_dict is None:
+        observation_dict = load_observation_dict()
+    
+    # Stem every term up front, in parallel
+    concepts = hpo.get_concepts()
+    terms = [concept.get_preferred_term() for concept in concepts]
+    terms.extend([term for concept in concepts for term in concept.get_all_terms()])
+    stemmed_terms_dict = dict(zip(terms, stem_terms(terms, workers=workers)))
+    
+    # Load prefs first, sometimes others' synonyms create conflicts.
+    hpo_dict = {}
+    for concept in concepts:
+        term = concept.get_preferred_term()
+        stemmed_term = stemmed_terms_dict[term]
+        if stemmed_term in hpo_dict.keys() and hpo_dict[stemmed_term] != concept.hpo_id \
+                                           and stemmed_term not in observation_dict['resolution']:
+            print('Warning: pref term already in dictionary: %s.' % stemmed_term)
+            print('\tConflicting HPO IDs: %s and %s.' % (hpo_dict[stemmed_term], concept.hpo_id))
+        else:
+            hpo_dict[stemmed_term] = concept.hpo_id
+
+    hpo_synonym_dict = {}
+    for concept in concepts:
+        terms = concept.get_all_terms()
+        stemmed_terms = [stemmed_terms_dict[term] for term in terms]
+        for stemmed_term in stemmed_terms:
+            if stemmed_term in hpo_dict.keys():
+                continue # Don't bother
+            if stemmed_term in hpo_synonym_dict.keys() and hpo_synonym_dict[stemmed_term] != concept.hpo_id \
+                                                       and stemmed_term not in observation_dict['resolution']:
+                print('Warning: synonym already in dictionary: %s.' % stemmed_term)
+                print('\tConflicting HPO IDs: %s and %s.' % (hpo_synonym_dict[stemmed_term], concept.hpo_id))
+            else:
+                hpo_synonym_dict[stemmed_term] = concept.hpo_id
+    
+    for synonym in hpo_synonym_dict.keys():
+        if synonym not in hpo_dict.keys():
+            hpo_dict[synonym] = hpo_synonym_dict[synonym]
+    return hpo_dict
+
+def get_lexicon_key(filepaths: List[str] = LEXICON_SOURCE_FILEPATHS) -> str:
+    key = hashlib.sha256(('lexicon-v%d' % LEXICON_VERSION).encode('utf-8'))
+    for filepath in filepaths:
+        file_hash = hashlib.sha256()
+        with open(filepath, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                file_hash.update(chunk)
+        key.update(('%s:%s\n' % (os.path.basename(filepath), file_hash.hexdigest())).encode('utf-8'))
+    return key.hexdigest()
+
+def build_lexicon(workers: int = None) -> Lexicon:
+    hpo = load_hpo_instance()
+    observation_dict = load_observation_dict()
+    hpo_dict = get_stemmed_hpo_dict(hpo, observation_dict, workers=workers)
+    return Lexicon(hpo, hpo_dict, observation_dict)
+
+# Loads the snapshot matching the current source files, rebuilding it if there is none.
+def load_lexicon(rebuild: bool = False) -> Lexicon:
+    filename = 'lexicon_%s.pkl' % get_lexicon_key()[:16]
+    if not rebuild and os.path.exists(os.path.join(CACHE_DIR, filename)):
+        try:
+            return load_from_cache(filename)
+        except Exception as e:
+            print('Warning: Could not load lexicon snapshot %s, rebuilding.' % filename)
+            print(e)
+    
+    lexicon = build_lexicon()
+    save_to_cache(filename, lexicon)
+    print('Saved lexicon snapshot: %s' % filename)
+    
+    # Remove snapshots of outdated sources, another process may be removing them too
+    for filepath in glob.glob(os.path.join(CACHE_DIR, 'lexicon_*.pkl')):
+        if os.path.basename(filepath) != filename:
+            try:
+                os.remove(filepath)
+            except FileNotFoundError:
+                pass
+    return lexicon
+
+lazy_lexicon = LazyValue(load_lexicon)
+
+def get_lexicon() -> Lexicon:
+    return lazy_lexicon.get()
@@ -1,40 +1,161 @@
-from typing import Tuple
+from typing import List, Tuple
 
-from base.dataset import Term
-from matching.dict_matching import match_hpo_dict, match_observation_dict
-#from matching.emb_matching import match_emb
+from base.dataset import Dataset, Term
+from matching.dict_matching import match_stemmed_hpo_dict, match_stemmed_observation_dict
+from matching.emb_matching import EMB_THRESHOLD, match_emb_batch
+from matching.fuzzy_matching import FUZZY_MIN_TRIGRAMS, FUZZY_THRESHOLD, match_stemmed_fuzzy
+from matching.lexicon import get_lexicon, stem_term, stem_terms
+from matching.normalization_cache import NORMALIZATION_CACHE_FILENAME, NormalizationCache, get_dict_fingerprint
+from util.caching import get_cache_filepath
 #from matching.es_matching import match_es
 #from matching.gpt_matching import match_gpt
 
+# Bump when the matching logic changes, cached results depend on it
+NORMALIZATION_VERSION = 1
+
+# Embedding matching is the last resort for terms no other matcher could match. It loads the spacy model
+# and builds the embedding index on first use, so it's opt-in. Set before creating a normalization cache.
+USE_EMB_MATCHING = False
+
 # Customizable Matching Logic
 
-# Takes term, returns HPO ID & matching method
-def match(term: Term, debug: bool = True) -> Tuple[str, str]:
-    predicted_term = term.get_preferred_term() # term predicted by model
-    observed_term = term.get_observed_term() # actual text within predicted span
+# Matchers used by match_stemmed and their settings, part of the normalization cache fingerprint
+def get_matcher_config() -> dict:
+    config = {
+        'version': NORMALIZATION_VERSION,
+        'matchers': ['hpo_dict', 'observation_dict', 'fuzzy'],
+        'fuzzy': {'threshold': FUZZY_THRESHOLD, 'min_trigrams': FUZZY_MIN_TRIGRAMS}
+    }
+    if USE_EMB_MATCHING:
+        config['matchers'].append('emb')
+        config['emb'] = {'threshold': EMB_THRESHOLD}
+    return config
+
+# Results are cached for the current dictionaries and matcher config, see matching.normalization_cache
+def get_normalization_cache(read_only: bool = False, max_size: int = 1 << 28,
+                            filepath: str = None) -> NormalizationCache:
+    if filepath is None:
+        filepath = get_cache_filepath(NORMALIZATION_CACHE_FILENAME)
+    lexicon = get_lexicon()
+    fingerprint = get_dict_fingerprint(lexicon.hpo_dict, lexicon.observation_dict, get_matcher_config())
+    return NormalizationCache(filepath, fingerprint, max_size=max_size, read_only=read_only)
 
-    if observed_term:
-        dict_id, method = match_hpo_dict(observed_term)
+# Takes stemmed predicted & observed terms, returns HPO ID & matching method.
+# Observed term is None if there is no text within the predicted span.
+def match_stemmed(stemmed_predicted_term: str, stemmed_observed_term: str = None) -> Tuple[str, str]:
+    if stemmed_observed_term is not None:
+        dict_id, method = match_stemmed_hpo_dict(stemmed_observed_term)
         if dict_id is not None:
             return dict_id, 'Observed term by %s' % method
-        obs_id, method = match_observation_dict(observed_term)
+        obs_id, method = match_stemmed_observation_dict(stemmed_observed_term)
         if obs_id is not None:
             return obs_id, 'Observed term by %s' % method
     
-    dict_id, method = match_hpo_dict(predicted_term)
+    dict_id, method = match_stemmed_hpo_dict(stemmed_predicted_term)
     if dict_id is not None:
         return dict_id, 'Predicted term by %s' % method
     
-    obs_id, method = match_observation_dict(predicted_term)
+    obs_id, method = match_stemmed_observation_dict(stemmed_predicted_term)
     if obs_id is not None:
         return obs_id, 'Predicted term by %s' % method
     
-    if observed_term is not None and debug:
-        print('Warning: Term not matched: %s [%s].' % (predicted_term, observed_term))
+    # Fall back to similar lexicon terms, e.g. for misspellings
+    if stemmed_observed_term is not None:
+        fuzzy_id, method = match_stemmed_fuzzy(stemmed_observed_term)
+        if fuzzy_id is not None:
+            return fuzzy_id, 'Observed term by %s' % method
+    
+    fuzzy_id, method = match_stemmed_fuzzy(stemmed_predicted_term)
+    if fuzzy_id is not None:
+        return fuzzy_id, 'Predicted term by %s' % method
+    
     return None, 'No match'
 
-def normalize_term(term: Term) -> Term:       
-    hpo_id, matcher = match(term) # Calculate HPO ID
+# Matches (predicted term, observed term) pairs with embeddings, observed terms first.
+# Every distinct term is vectorized and scored in one batch.
+# Returns pair -> (HPO ID, matching method) for the matched pairs.
+def match_emb_pairs(pairs: List[Tuple[str, str]]) -> dict:
+    strings = list(dict.fromkeys([string for pair in pairs for string in pair if string]))
+    emb_matches = dict(zip(strings, match_emb_batch(strings)))
+    
+    matches = {}
+    for predicted_term, observed_term in pairs:
+        for name, string in [('Observed', observed_term), ('Predicted', predicted_term)]:
+            if string and emb_matches[string][0] is not None:
+                emb_id, method = emb_matches[string]
+                matches[(predicted_term, observed_term)] = (emb_id, '%s term by %s' % (name, method))
+                break
+    return matches
+
+# Takes term, returns HPO ID & matching method.
+# Use functools.partial to pass a normalization cache along with match as an evaluation match_func.
+def match(term: Term, debug: bool = True, normalization_cache: NormalizationCache = None) -> Tuple[str, str]:
+    predicted_term = term.get_preferred_term() # term predicted by model
+    observed_term = term.get_observed_term() # actual text within predicted span
+
+    result = None
+    if normalization_cache is not None:
+        result = normalization_cache.lookup(predicted_term, observed_term or None)
+    if result is None:
+        result = match_stemmed(stem_term(predicted_term), stem_term(observed_term) if observed_term else None)
+        if result[0] is None and USE_EMB_MATCHING:
+            pair = (predicted_term, observed_term or None)
+            result = match_emb_pairs([pair]).get(pair, result)
+        if normalization_cache is not None:
+            normalization_cache.store(predicted_term, observed_term or None, result)
+    hpo_id, method = result
+    
+    if hpo_id is None and observed_term is not None and debug:
+        print('Warning: Term not matched: %s [%s].' % (predicted_term, observed_term))
+    return hpo_id, method
+
+def normalize_term(term: Term, normalization_cache: NormalizationCache = None) -> Term:
+    hpo_id, matcher = match(term, normalization_cache=normalization_cache) # Calculate HPO ID
     term.hpo_id = hpo_id
     term.matcher = matcher
-    return term
\ No newline at end of file
+    return term
+
+# Normalizes every term of the dataset in place, with the same results as normalize_term.
+# Predicted and observed terms repeat across observations, so each distinct string is stemmed
+# and each distinct pair is matched only once. Pairs found in normalization_cache aren't matched again.
+# Returns the number of distinct pairs per matcher.
+def normalize_dataset(dataset: Dataset, debug: bool = True, normalization_cache: NormalizationCache = None) -> dict:
+    terms = [term for observation in dataset.observations for term in observation.terms]
+    pairs = [(term.get_preferred_term(), term.get_observed_term() or None) for term in terms]
+    unique_pairs = list(dict.fromkeys(pairs))
+    
+    matches = {}
+    if normalization_cache is not None:
+        matches = normalization_cache.lookup_many(unique_pairs)
+    uncached_pairs = [pair for pair in unique_pairs if pair not in matches]
+    
+    # Stem unique strings in bulk
+    strings = list(dict.fromkeys([string for pair in uncached_pairs for string in pair if string is not None]))
+    stemmed_strings = dict(zip(strings, stem_terms(strings)))
+    stemmed_strings[None] = None
+    
+    new_matches = {}
+    for predicted_term, observed_term in uncached_pairs:
+        new_matches[(predicted_term, observed_term)] = match_stemmed(stemmed_strings[predicted_term],
+                                                                     stemmed_strings[observed_term])
+    if USE_EMB_MATCHING:
+        new_matches.update(match_emb_pairs([pair for pair, (hpo_id, _) in new_matches.items() if hpo_id is None]))
+    if normalization_cache is not None:
+        normalization_cache.store_many(new_matches)
+    matches.update(new_matches)
+    
+    matcher_counts = {}
+    for predicted_term, observed_term in unique_pairs:
+        hpo_id, matcher = matches[(predicted_term, observed_term)]
+        matcher_counts[matcher] = matcher_counts.get(matcher, 0) + 1
+        if hpo_id is None and debug:
+            print('Warning: Term not matched: %s [%s].' % (predicted_term, observed_term or ''))
+    
+    for term, pair in zip(terms, pairs):
+        term.hpo_id, term.matcher = matches[pair]
+    
+    if debug:
+        print('Normalized %d terms, %d distinct.' % (len(terms), len(unique_pairs)))
+        for matcher, count in sorted(matcher_counts.items(), key=lambda x: -x[1]):
+            print('\t%s: %d' % (matcher, count))
+    return matcher_counts
\ No newline at end of file
@@ -0,0 +1,100 @@
+# Persistent cache of normalization results, (predicted term, observed term) -> (HPO ID, matcher).
+# Results only change with the dictionaries and the matcher config, so keys are prefixed with
+# their fingerprint. Entries of outdated dictionaries are never hit again and age out by LRU eviction.
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import List, Tuple
+
+from util.caching import SQLiteCache
+
+NORMALIZATION_CACHE_FILENAME = 'normalization.sqlite'
+
+def get_dict_fingerprint(hpo_dict: dict, observation_dict: dict, matcher_config: dict) -> str:
+    fingerprint = hashlib.sha256()
+    for name, value in [('hpo_dict', hpo_dict), ('observation_dict', observation_dict), ('config', matcher_config)]:
+        fingerprint.update(('%s:%s\n' % (name, json.dumps(value, sort_keys=True, ensure_ascii=False))).encode('utf-8'))
+    return fingerprint.hexdigest()
+
+# Recently used results are also kept in memory, up to memory_size pairs.
+# On disk, least recently used entries are evicted once values exceed max_size bytes.
+class NormalizationCache:
+    def __init__(self, filepath: str, fingerprint: str, max_size: int = 1 << 28, memory_size: int = 2**16,
+                 read_only: bool = False):
+        self.fingerprint = fingerprint
+        self.memory_size = memory_size
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.sqlite_cache = SQLiteCache(filepath, max_size=max_size, read_only=read_only)
+
+    def get_key(self, predicted_term: str, observed_term: str) -> str:
+        pair = json.dumps([predicted_term, observed_term], ensure_ascii=False)
+        return '%s:%s' % (self.fingerprint[:16], hashlib.sha256(pair.encode('utf-8')).hexdigest())
+
+    def remember(self, pair: Tuple[str, str], result: Tuple[str, str]):
+        with self.lock:
+            self.results[pair] = result
+            self.results.move_to_end(pair)
+            while len(self.results) > self.memory_size:
+                self.results.popitem(last=False)
+
+    def lookup_memory(self, pair: Tuple[str, str]) -> Tuple[str, str]:
+        with self.lock:
+            result = self.results.get(pair)
+            if result is not None:
+                self.results.move_to_end(pair)
+            return result
+
+    # Returns (HPO ID, matcher), or None if the pair isn't cached
+    def lookup(self, predicted_term: str, observed_term: str) -> Tuple[str, str]:
+        return self.lookup_many([(predicted_term, observed_term)]).get((predicted_term, observed_term))
+
+    # Returns pair -> (HPO ID, matcher) for the cached pairs, reading the database once
+    def lookup_many(self, pairs: List[Tuple[str, str]]) -> dict:
+        results = {}
+        keys = {}
+        for pair in dict.fromkeys(pairs):
+            result = self.lookup_memory(pair)
+            if result is not None:
+                results[pair] = result
+            else:
+                keys[self.get_key(*pair)] = pair
+        if len(keys) > 0:
+            for key, value in self.sqlite_cache.get_many(list(keys.keys())).items():
+                results[keys[key]] = tuple(json.loads(value))
+                self.remember(keys[key], results[keys[key]])
+        with self.lock:
+            self.hits += len(results)
+            self.misses += len(pairs) - len(results)
+        return results
+
+    def store(self, predicted_term: str, observed_term: str, result: Tuple[str, str]):
+        self.store_many({(predicted_term, observed_term): result})
+
+    # Takes pair -> (HPO ID, matcher), writes them in one transaction
+    def store_many(self, results: dict):
+        for pair, result in results.items():
+            self.remember(pair, tuple(result))
+        self.sqlite_cache.set_many({self.get_key(*pair): json.dumps(list(result)) for pair, result in results.items()})
+
+    def get_stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / requests if requests > 0 else 0.0,
+            'memory_entries': len(self.results),
+            'size': self.sqlite_cache.size
+        }
+
+    def print_stats(self):
+        stats = self.get_stats()
+        print('Normalization cache: %d hits, %d misses (%.1f%% hit rate).' % \
+              (stats['hits'], stats['misses'], 100 * stats['hit_rate']))
+
+    def close(self):
+        self.sqlite_cache.close()
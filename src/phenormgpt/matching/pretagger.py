@@ -0,0 +1,116 @@
+# Dictionary pre-tagging of observations.
+# Observations are tagged in one pass over their tokens with a token trie of every stemmed dictionary term.
+# Observations fully explained by dictionary terms, as judged by a PretagPolicy, don't need a model request.
+
+from typing import List, Tuple
+
+from base.dataset import Observation, Term
+from matching.dict_matching import get_stemmed_term_dict
+from matching.lexicon import get_lexicon, stem_term
+from util.lazy import LazyValue
+from util.stemming import RE_PUNCT
+
+PRETAGGER_MATCHER = 'Observed term by Dictionary pretagging'
+
+# Words that change the meaning of the terms around them, left to the model
+BLOCKED_WORDS = ['absence', 'absent', 'negative', 'neither', 'no', 'none', 'nor', 'normal', 'not',
+                 'unremarkable', 'without']
+
+# Key of the HPO ID in trie nodes, tokens are never empty
+TRIE_END = ''
+
+class Pretagger:
+    def __init__(self, term_dict: dict):
+        self.trie = {}
+        for stemmed_term, hpo_id in term_dict.items():
+            tokens = stemmed_term.split()
+            if len(tokens) == 0:
+                continue
+            node = self.trie
+            for token in tokens:
+                node = node.setdefault(token, {})
+            node[TRIE_END] = hpo_id
+
+    # Stemmed tokens of the text from begin, with their character offsets. Stop words are dropped like in stem_term.
+    # Returns the tokens and the words of the text, lowercased.
+    def tokenize(self, text: str, begin: int = 0) -> Tuple[List[Tuple[str, int, int]], List[str]]:
+        tokens = []
+        words = []
+        boundaries = [(separator.start(), separator.end()) for separator in RE_PUNCT.finditer(text, begin)]
+        position = begin
+        for start, end in boundaries + [(len(text), len(text))]:
+            if start > position:
+                word = text[position:start]
+                words.append(word.lower())
+                # Words have no punctuation, but may still stem to several tokens, e.g. contractions
+                for token in stem_term(word).split():
+                    tokens.append((token, position, start))
+            position = end
+        return tokens, words
+
+    # Tags the text after its body location, longest matches first from left to right.
+    # Returns (HPO ID, span) of every tagged term, the share of tokens tagged, and the words of the text.
+    def tag(self, text: str) -> Tuple[List[Tuple[str, str]], float, List[str]]:
+        tokens, words = self.tokenize(text, text.index(':') + 1 if ':' in text else 0)
+        tags = []
+        num_tagged = 0
+        i = 0
+        while i < len(tokens):
+            node = self.trie
+            match = None
+            for j in range(i, len(tokens)):
+                node = node.get(tokens[j][0])
+                if node is None:
+                    break
+                if TRIE_END in node:
+                    match = (j, node[TRIE_END])
+            if match is None:
+                i += 1
+                continue
+            j, hpo_id = match
+            tags.append((hpo_id, '%d-%d' % (tokens[i][1], tokens[j][2])))
+            num_tagged += j - i + 1
+            i = j + 1
+        return tags, num_tagged / len(tokens) if len(tokens) > 0 else 0.0, words
+
+# Decides which tagged observations don't need a model request
+class PretagPolicy:
+    def __init__(self, min_coverage: float = 1.0, min_terms: int = 1, max_terms: int = None,
+                 blocked_words: List[str] = BLOCKED_WORDS):
+        self.min_coverage = min_coverage
+        self.min_terms = min_terms
+        self.max_terms = max_terms
+        self.blocked_words = frozenset(blocked_words)
+
+    def accept(self, tags: List[Tuple[str, str]], coverage: float, words: List[str]) -> bool:
+        if coverage < self.min_coverage or len(tags) < self.min_terms:
+            return False
+        if self.max_terms is not None and len(tags) > self.max_terms:
+            return False
+        return not any(word in self.blocked_words for word in words)
+
+lazy_pretagger = LazyValue(lambda: Pretagger(get_stemmed_term_dict()))
+
+def get_pretagger() -> Pretagger:
+    return lazy_pretagger.get()
+
+# Returns the observation with its tagged, normalized terms, or None if it needs a model request
+def pretag_observation(observation: Observation, policy: PretagPolicy = None,
+                       pretagger: Pretagger = None) -> Observation:
+    if policy is None:
+        policy = PretagPolicy()
+    if pretagger is None:
+        pretagger = get_pretagger()
+    tags, coverage, words = pretagger.tag(observation.text)
+    if not policy.accept(tags, coverage, words):
+        return None
+
+    hpo = get_lexicon().hpo
+    prediction = observation.get_observation_text()
+    for hpo_id, span in tags:
+        concept = hpo.get_concept_by_hpo_id(hpo_id)
+        term = Term(hpo_id, concept.get_preferred_term() if concept is not None else None, False, [span],
+                    observation.text)
+        term.matcher = PRETAGGER_MATCHER
+        prediction.add_term(term)
+    return prediction
@@ -0,0 +1,233 @@
+# Streaming extraction pipeline.
+# Observations flow through prompt building, requests, parsing and normalization into the output TSV,
+# with bounded queues between stages, so memory stays flat and predictions are written as they arrive.
+
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import nullcontext
+from typing import Iterable, Iterator, List, Tuple
+
+from base.dataset import Dataset, Observation, TSV_HEADERS
+from base.hpo import HPO
+from base.response_parser import ResponseParser
+from matching.normalization import normalize_term
+from matching.normalization_cache import NormalizationCache
+from matching.pretagger import PretagPolicy, pretag_observation
+from prompting.generate_messages import get_openai_messages_for_observation
+from prompting.openai_client import OpenAIClient
+from prompting.similarity import get_observation_vectors, get_similarity_index
+from util.timing import StageTimer
+
+def measure(timer: StageTimer, name: str):
+    return timer.measure(name) if timer is not None else nullcontext()
+
+# Marks the end of a stage's output
+STAGE_END = object()
+
+class StageError:
+    def __init__(self, exception: BaseException):
+        self.exception = exception
+
+# Prediction of an observation tagged from the dictionaries, in place of messages and responses
+class Pretagged:
+    def __init__(self, prediction: Observation):
+        self.prediction = prediction
+
+# Runs the iterable in its own thread, handing items over through a bounded queue.
+# Exceptions are raised in the consuming thread. The thread stops once the consumer stops.
+def run_stage(iterable: Iterable, queue_size: int = 64) -> Iterator:
+    items = queue.Queue(maxsize=queue_size)
+    stopped = threading.Event()
+
+    def put(item) -> bool:
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+            put(STAGE_END)
+        except BaseException as e:
+            put(StageError(e))
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is STAGE_END:
+                break
+            if isinstance(item, StageError):
+                raise item.exception
+            yield item
+    finally:
+        stopped.set()
+
+# Yields (observation, messages), vectorizing observations for few shot search in batches.
+# Observations accepted by pretag_policy when given yield (observation, Pretagged) instead, without a prompt.
+def iter_prompts(observations: Iterable[Observation], hpo: HPO, few_shot_dataset: Dataset = None,
+                 batch_size: int = 256, timer: StageTimer = None, pretag_policy: PretagPolicy = None,
+                 **message_parameters) -> Iterator[Tuple[Observation, List[dict]]]:
+    few_shot_index = None
+    if few_shot_dataset is not None:
+        few_shot_index = get_similarity_index(few_shot_dataset)
+
+    observations = iter(observations)
+    while True:
+        batch = [observation for _, observation in zip(range(batch_size), observations)]
+        if len(batch) == 0:
+            break
+        predictions = [None] * len(batch)
+        if pretag_policy is not None:
+            with measure(timer, 'pretag'):
+                predictions = [pretag_observation(observation, pretag_policy) for observation in batch]
+        prompted = [observation for observation, prediction in zip(batch, predictions) if prediction is None]
+
+        query_vectors = [None] * len(prompted)
+        if few_shot_index is not None and len(prompted) > 0:
+            with measure(timer, 'vectorize'):
+                query_vectors = get_observation_vectors(prompted)
+        query_vectors = iter(query_vectors)
+        for observation, prediction in zip(batch, predictions):
+            if prediction is not None:
+                yield observation, Pretagged(prediction)
+                continue
+            query_vector = next(query_vectors)
+            with measure(timer, 'prompt'):
+                messages = get_openai_messages_for_observation(observation, hpo, include_response=False,
+                                                               few_shot_dataset=few_shot_dataset,
+                                                               few_shot_index=few_shot_index,
+                                                               query_vector=query_vector, **message_parameters)
+            yield observation, messages
+
+# Yields (observation, response) in input order, failed requests yield their exception instead.
+# Pretagged items aren't requested, they are passed on in place of their response.
+# At most max_pending items are requested ahead of the oldest unanswered one.
+def iter_ordered_responses(openai_client: OpenAIClient, prompts: Iterable[Tuple[Observation, List[dict]]],
+                           max_concurrency: int = 8, max_pending: int = None,
+                           timer: StageTimer = None) -> Iterator[Tuple[Observation, str]]:
+    if max_pending is None:
+        max_pending = 4 * max_concurrency
+
+    def get_response(messages: List[dict]) -> str:
+        with measure(timer, 'request'):
+            return openai_client.get_response(messages)
+
+    prompts = iter(prompts)
+    futures = {}
+    results = {}
+    num_submitted = 0
+    next_index = 0
+    exhausted = False
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        while True:
+            while not exhausted and len(futures) < max_concurrency and num_submitted - next_index < max_pending:
+                try:
+                    observation, messages = next(prompts)
+                except StopIteration:
+                    exhausted = True
+                    break
+                if isinstance(messages, Pretagged):
+                    results[num_submitted] = (observation, messages)
+                else:
+                    futures[executor.submit(get_response, messages)] = (num_submitted, observation)
+                num_submitted += 1
+
+            if len(futures) > 0:
+                done, _ = wait(futures.keys(), return_when=FIRST_COMPLETED)
+                for future in done:
+                    index, observation = futures.pop(future)
+                    try:
+                        results[index] = (observation, future.result())
+                    except Exception as e:
+                        results[index] = (observation, e)
+            while next_index in results:
+                yield results.pop(next_index)
+                next_index += 1
+            if exhausted and len(futures) == 0:
+                break
+
+# Yields observations with normalized terms. Failed requests are counted in stats,
+# and their observations are yielded without terms. Rows that can't be parsed are counted by the parser.
+def iter_predictions(responses: Iterable[Tuple[Observation, str]], normalize: bool = True,
+                     stats: dict = None, timer: StageTimer = None, response_parser: ResponseParser = None,
+                     normalization_cache: NormalizationCache = None) -> Iterator[Observation]:
+    if stats is None:
+        stats = {}
+    stats.setdefault('failed_requests', 0)
+    stats.setdefault('pretagged', 0)
+    if response_parser is None:
+        response_parser = ResponseParser()
+    for observation, response in responses:
+        if isinstance(response, Pretagged):
+            stats['pretagged'] += 1
+            yield response.prediction
+            continue
+        if isinstance(response, Exception):
+            print('Error: Request failed for observation %s: %s' % (observation.observation_id, response))
+            stats['failed_requests'] += 1
+            yield observation.get_observation_text()
+            continue
+        with measure(timer, 'parse'):
+            prediction = response_parser.parse(observation.text, response)
+            prediction.copy_id(observation)
+        if normalize:
+            with measure(timer, 'normalize'):
+                prediction.terms = [normalize_term(term, normalization_cache) for term in prediction.terms]
+        yield prediction
+
+# Appends prediction rows to the TSV as each observation arrives
+def write_predictions(predictions: Iterable[Observation], output_filepath: str, timer: StageTimer = None) -> int:
+    num_observations = 0
+    with open(output_filepath, 'w', buffering=1) as outfile:
+        outfile.write(TSV_HEADERS)
+        for prediction in predictions:
+            with measure(timer, 'write'):
+                prediction.write_to_tsv(outfile)
+            num_observations += 1
+    return num_observations
+
+# Runs the whole pipeline, observations can be any iterable, e.g. iter_observations_from_file_no_terms.
+# Message parameters are passed to get_openai_messages_for_observation.
+# Rows that can't be parsed are logged to reject_log_filepath when given.
+# Terms are normalized through normalization_cache when given, see get_normalization_cache.
+# Observations accepted by pretag_policy when given are tagged from the dictionaries, without a request.
+# Pretagged terms are normalized, so there is no pretagging without normalize.
+# Returns stats of the run, time spent per stage is added to timer when given.
+def run_pipeline(observations: Iterable[Observation], output_filepath: str, openai_client: OpenAIClient, hpo: HPO,
+                 few_shot_dataset: Dataset = None, max_concurrency: int = 8, queue_size: int = 64,
+                 normalize: bool = True, timer: StageTimer = None, reject_log_filepath: str = None,
+                 normalization_cache: NormalizationCache = None, pretag_policy: PretagPolicy = None,
+                 **message_parameters) -> dict:
+    if pretag_policy is not None and not normalize:
+        print('Warning: Pretagging needs normalization, sending every observation to the model.')
+        pretag_policy = None
+
+    stats = {}
+    response_parser = ResponseParser(reject_log_filepath)
+    prompts = run_stage(iter_prompts(observations, hpo, few_shot_dataset, timer=timer, pretag_policy=pretag_policy,
+                                     **message_parameters), queue_size)
+    responses = run_stage(iter_ordered_responses(openai_client, prompts, max_concurrency, timer=timer), queue_size)
+    predictions = iter_predictions(responses, normalize, stats, timer, response_parser, normalization_cache)
+    try:
+        stats['observations'] = write_predictions(predictions, output_filepath, timer)
+    finally:
+        response_parser.close()
+    stats['rejected_rows'] = response_parser.counts['rejected_rows']
+
+    print('Wrote predictions for %d observations to %s.' % (stats['observations'], output_filepath))
+    response_parser.print_counts()
+    if pretag_policy is not None:
+        print('Pretagged %d of %d observations from the dictionaries, %d requests saved.' % \
+              (stats['pretagged'], stats['observations'], stats['pretagged']))
+    if stats['failed_requests'] > 0:
+        print('Warning: %d requests failed, their observations have no terms.' % stats['failed_requests'])
+    return stats
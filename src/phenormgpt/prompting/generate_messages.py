@@ -2,18 +2,20 @@
 # For both fine-tuning and few-shotting
 
 import os
-from random import shuffle
+import threading
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from random import Random, shuffle
 from tqdm import tqdm
 from typing import List
 
 from base.dataset import Dataset, Observation, Term
 from base.hpo import HPO
 from config.config import FINE_TUNE_DIR
-from prompting.openai_dataset_analysis import save_to_jsonl
+from prompting.openai_dataset_analysis import num_tokens_from_messages, num_tokens_from_messages_batch, save_to_jsonl
 from prompting.prompts import EMPTY_RESPONSE_MESSAGE
-from prompting.similarity import get_n_most_similar_observations
-
-os.makedirs(FINE_TUNE_DIR, exist_ok=True)
+from prompting.similarity import SimilarityIndex, get_observation_vectors, get_similarity_index
 
 def get_assistant_message_line(term: Term, hpo: HPO) -> str:
     concept = hpo.get_concept_by_hpo_id(term.hpo_id)
@@ -24,11 +26,93 @@ def get_assistant_message_line(term: Term, hpo: HPO) -> str:
     assistant_message_line = '| %s | %s |' % (preferred_term, tagged_text)
     return assistant_message_line
 
+# Maximum number of memoized few shot examples, least recently used ones are dropped first
+FEW_SHOT_MESSAGES_CACHE_SIZE = 2**16
+
+# Key -> (HPO, user and assistant messages).
+# Keys hold everything the messages are built from, so examples of another HPO or training set,
+# or whose terms changed, e.g. with Dataset.filter_by_hpo_ids, are never served stale messages.
+few_shot_messages_cache = OrderedDict()
+few_shot_messages_cache_lock = threading.Lock()
+
+def get_few_shot_messages_key(observation: Observation, hpo: HPO, user_message_wrapper: str,
+                              assistant_message_table_header: str) -> tuple:
+    terms = tuple([(term.hpo_id, term.text, tuple(term.spans)) for term in observation.terms])
+    return (id(hpo), observation.text, terms, user_message_wrapper, assistant_message_table_header)
+
+# User and assistant messages of an annotated observation.
+# Memoized, since the same examples recur across thousands of prompts.
+def get_few_shot_messages(observation: Observation, hpo: HPO, user_message_wrapper: str = None,
+                          assistant_message_table_header: str = None) -> List[dict]:
+    key = get_few_shot_messages_key(observation, hpo, user_message_wrapper, assistant_message_table_header)
+    with few_shot_messages_cache_lock:
+        cached = few_shot_messages_cache.get(key)
+        # IDs of freed HPOs may be reused
+        if cached is not None and cached[0] is hpo:
+            few_shot_messages_cache.move_to_end(key)
+            messages = cached[1]
+        else:
+            messages = None
+    if messages is None:
+        messages = get_openai_messages_for_observation(observation, hpo, user_message_wrapper=user_message_wrapper,
+                                                       assistant_message_table_header=assistant_message_table_header)
+        with few_shot_messages_cache_lock:
+            few_shot_messages_cache[key] = (hpo, messages)
+            few_shot_messages_cache.move_to_end(key)
+            while len(few_shot_messages_cache) > FEW_SHOT_MESSAGES_CACHE_SIZE:
+                few_shot_messages_cache.popitem(last=False)
+    return [dict(message) for message in messages]
+
+# Frees the memoized messages, e.g. once prompts are generated
+def clear_few_shot_messages_cache():
+    with few_shot_messages_cache_lock:
+        few_shot_messages_cache.clear()
+
+# Tokens added to a prompt by a few shot example.
+# Reply priming tokens are already counted in the prompt.
+def num_tokens_from_few_shot_observation(observation: Observation, hpo: HPO, user_message_wrapper: str = None,
+                                         assistant_message_table_header: str = None) -> int:
+    messages = get_few_shot_messages(observation, hpo, user_message_wrapper, assistant_message_table_header)
+    return num_tokens_from_messages(messages) - 3
+
+# Few shot examples to keep within max_prompt_tokens.
+# Examples backfilled to reach few_shot_k_min on the short side (with or without terms) go first,
+# the rest are added in similarity order, then hand picked examples, while they fit in the budget.
+def select_few_shot_observations(observation: Observation, few_shot_observations: List[Observation],
+                                 hand_picked_observations: List[Observation], hpo: HPO, max_prompt_tokens: int,
+                                 num_prompt_tokens: int, backfilled_observations: List[Observation] = [],
+                                 user_message_wrapper: str = None,
+                                 assistant_message_table_header: str = None) -> List[Observation]:
+    # Similar examples come first, followed by hand picked ones
+    candidates = []
+    candidate_ids = set([observation.observation_id])
+    for few_shot_observation in few_shot_observations + hand_picked_observations:
+        if few_shot_observation.observation_id not in candidate_ids:
+            candidate_ids.add(few_shot_observation.observation_id)
+            candidates.append(few_shot_observation)
+    
+    backfilled_ids = set([backfilled_observation.observation_id for backfilled_observation in backfilled_observations])
+    selected_ids = set()
+    for candidate in [candidate for candidate in candidates if candidate.observation_id in backfilled_ids] + \
+                     [candidate for candidate in candidates if candidate.observation_id not in backfilled_ids]:
+        num_candidate_tokens = num_tokens_from_few_shot_observation(candidate, hpo, user_message_wrapper,
+                                                                    assistant_message_table_header)
+        if num_prompt_tokens + num_candidate_tokens <= max_prompt_tokens:
+            selected_ids.add(candidate.observation_id)
+            num_prompt_tokens += num_candidate_tokens
+    
+    if num_prompt_tokens > max_prompt_tokens:
+        print('Warning: Prompt for observation %s has %d tokens, over the budget of %d.' % \
+              (observation.observation_id, num_prompt_tokens, max_prompt_tokens))
+    return [candidate for candidate in candidates if candidate.observation_id in selected_ids]
+
 def get_openai_messages_for_observation(observation: Observation, hpo: HPO, system_message: str = None,
                                         user_message_wrapper: str = None, assistant_message_table_header: str = None,
                                         include_response: bool = True, few_shot_dataset: Dataset = None,
                                         few_shot_k: int = 10, few_shot_k_min: int = 3,
-                                        hand_picked_dataset: Dataset = None) -> List[dict]:
+                                        hand_picked_dataset: Dataset = None, few_shot_index: SimilarityIndex = None,
+                                        query_vector: np.ndarray = None, max_prompt_tokens: int = None,
+                                        prefix_stable: bool = False, seed: int = None) -> List[dict]:
     messages = []
     
     # System message, if any
@@ -37,42 +121,88 @@ def get_openai_messages_for_observation(observation: Observation, hpo: HPO, syst
     
     # Add few shot messages here, based on similarity, if any
     if few_shot_dataset is not None:
-        dataset = get_n_most_similar_observations(few_shot_dataset, observation, few_shot_k)      
+        if few_shot_index is None:
+            few_shot_index = get_similarity_index(few_shot_dataset)
+        if query_vector is None:
+            query_vector = few_shot_index.get_query_vector(observation)
+        dataset = few_shot_index.get_n_most_similar_observations(observation, few_shot_k, query_vector=query_vector)
         few_shot_observations = dataset.observations
+        backfilled_observations = []
         
         num_observations_with_terms = len([few_shot_observation for few_shot_observation in few_shot_observations \
                                            if few_shot_observation.has_terms()])
         # We have no observation examples with actual terms
         if num_observations_with_terms < few_shot_k_min:
             num_observations_needed = few_shot_k_min
-            dataset_w_terms = get_n_most_similar_observations(few_shot_dataset.filter_has_terms(), observation, num_observations_needed)
+            dataset_w_terms = few_shot_index.get_n_most_similar_observations(observation, num_observations_needed, subset='terms',
+                                                                             query_vector=query_vector)
             observations_w_terms = dataset_w_terms.observations
             few_shot_observations.extend(observations_w_terms)
+            backfilled_observations = observations_w_terms
             
         # We have no observation examples with no terms (NA)
         elif len(few_shot_observations) - num_observations_with_terms < few_shot_k_min:
             num_observations_needed = few_shot_k_min
-            na_dataset = get_n_most_similar_observations(few_shot_dataset.filter_no_terms(), observation, num_observations_needed)
+            na_dataset = few_shot_index.get_n_most_similar_observations(observation, num_observations_needed, subset='na',
+                                                                        query_vector=query_vector)
             na_observations = na_dataset.observations
             few_shot_observations.extend(na_observations)
+            backfilled_observations = na_observations
         
         # Add handpick dataset filtered by observation.bodyloc here...
+        hand_picked_observations = []
         if hand_picked_dataset is not None:
             hand_picked_observations = hand_picked_dataset.filter_bodylocs([observation.bodyloc]).observations
-            few_shot_observations.extend(hand_picked_observations)
         
-        shuffle(few_shot_observations)
+        num_prompt_tokens = 0
+        if max_prompt_tokens is not None:
+            observation_messages = get_openai_messages_for_observation(observation, hpo, system_message, user_message_wrapper,
+                                                                       assistant_message_table_header, include_response)
+            num_prompt_tokens = num_tokens_from_messages(observation_messages)
+        
+        if prefix_stable:
+            if seed is None:
+                seed = 0
+            # Prompts of a body location share the system message and hand picked examples as a prefix,
+            # so they go first in an order seeded by body location. Per-target examples follow in a seeded order.
+            Random('%d:%s' % (seed, observation.bodyloc)).shuffle(hand_picked_observations)
+            hand_picked_ids = set([hand_picked_observation.observation_id for hand_picked_observation in hand_picked_observations])
+            few_shot_observations = [few_shot_observation for few_shot_observation in few_shot_observations \
+                                     if few_shot_observation.observation_id not in hand_picked_ids]
+            if max_prompt_tokens is not None:
+                num_prompt_tokens += sum([num_tokens_from_few_shot_observation(hand_picked_observation, hpo, user_message_wrapper,
+                                                                               assistant_message_table_header) \
+                                          for hand_picked_observation in hand_picked_observations])
+                few_shot_observations = select_few_shot_observations(observation, few_shot_observations, [], hpo,
+                                                                     max_prompt_tokens, num_prompt_tokens, backfilled_observations,
+                                                                     user_message_wrapper, assistant_message_table_header)
+            Random('%d:%s' % (seed, observation.observation_id)).shuffle(few_shot_observations)
+            few_shot_observations = hand_picked_observations + few_shot_observations
+        else:
+            # Only keep as many examples as fit in the token budget
+            if max_prompt_tokens is not None:
+                few_shot_observations = select_few_shot_observations(observation, few_shot_observations, hand_picked_observations,
+                                                                     hpo, max_prompt_tokens, num_prompt_tokens,
+                                                                     backfilled_observations, user_message_wrapper,
+                                                                     assistant_message_table_header)
+            else:
+                few_shot_observations.extend(hand_picked_observations)
+            
+            # A seed makes prompts reproducible, independent of the order they are generated in
+            if seed is None:
+                shuffle(few_shot_observations)
+            else:
+                Random('%d:%s' % (seed, observation.observation_id)).shuffle(few_shot_observations)
         
-        added_few_shot_observation_ids = []
+        added_few_shot_observation_ids = set()
         for few_shot_observation in few_shot_observations:
             if few_shot_observation.observation_id == observation.observation_id:
                 print('Warning: Target observation included in the few shot dataset.')
                 continue
             if few_shot_observation.observation_id not in added_few_shot_observation_ids:
-                added_few_shot_observation_ids.append(few_shot_observation.observation_id)
-                messages.extend(get_openai_messages_for_observation(few_shot_observation, hpo,
-                                                                    user_message_wrapper = user_message_wrapper,
-                                                                    assistant_message_table_header = assistant_message_table_header))
+                added_few_shot_observation_ids.add(few_shot_observation.observation_id)
+                messages.extend(get_few_shot_messages(few_shot_observation, hpo, user_message_wrapper,
+                                                      assistant_message_table_header))
         
     # User message, provide the observation
     user_message = observation.text
@@ -107,13 +237,115 @@ def get_openai_messages_for_observation(observation: Observation, hpo: HPO, syst
 def get_openai_messages(dataset: Dataset, hpo: HPO, system_message: str = None,
                               user_message_wrapper: str = None, assistant_message_table_header: str = None,
                               include_response: bool = True, few_shot_dataset: Dataset = None, few_shot_k: int = 15,
-                              few_shot_k_min: int = 3, hand_picked_dataset: Dataset = None) -> List[dict]:
+                              few_shot_k_min: int = 3, hand_picked_dataset: Dataset = None,
+                              max_prompt_tokens: int = None, prefix_stable: bool = False, seed: int = None) -> List[dict]:
+        # Build the few shot index once, and vectorize all observations in a single batch
+        few_shot_index = None
+        query_vectors = [None] * len(dataset.observations)
+        if few_shot_dataset is not None:
+            few_shot_index = get_similarity_index(few_shot_dataset)
+            query_vectors = get_observation_vectors(dataset.observations)
+
         messages = [get_openai_messages_for_observation(observation, hpo, system_message, user_message_wrapper,
                                                         assistant_message_table_header, include_response, few_shot_dataset,
-                                                        few_shot_k, few_shot_k_min, hand_picked_dataset) \
-                    for observation in tqdm(dataset.observations)]
+                                                        few_shot_k, few_shot_k_min, hand_picked_dataset,
+                                                        few_shot_index, query_vector, max_prompt_tokens,
+                                                        prefix_stable, seed) \
+                    for observation, query_vector in tqdm(zip(dataset.observations, query_vectors),
+                                                          total=len(dataset.observations))]
         return messages
 
+# Set once per worker process by init_openai_messages_worker
+openai_messages_worker_state = {}
+
+def init_openai_messages_worker(hpo: HPO, few_shot_dataset: Dataset, hand_picked_dataset: Dataset, parameters: dict):
+    openai_messages_worker_state['hpo'] = hpo
+    openai_messages_worker_state['few_shot_dataset'] = few_shot_dataset
+    openai_messages_worker_state['hand_picked_dataset'] = hand_picked_dataset
+    # Memory-mapped from the index saved by the main process
+    openai_messages_worker_state['few_shot_index'] = get_similarity_index(few_shot_dataset) \
+                                                     if few_shot_dataset is not None else None
+    openai_messages_worker_state['parameters'] = parameters
+
+def get_openai_messages_chunk(observations: List[Observation], query_vectors: List[np.ndarray]) -> List[List[dict]]:
+    state = openai_messages_worker_state
+    return [get_openai_messages_for_observation(observation, state['hpo'], few_shot_dataset=state['few_shot_dataset'],
+                                                hand_picked_dataset=state['hand_picked_dataset'],
+                                                few_shot_index=state['few_shot_index'], query_vector=query_vector,
+                                                **state['parameters']) \
+            for observation, query_vector in zip(observations, query_vectors)]
+
+# Parallel version of get_openai_messages, with the same output for the same seed.
+# Without a seed, examples are shuffled randomly like in get_openai_messages, see get_openai_messages_for_observation.
+# Observations are split into chunks over worker processes, which get the datasets and HPO once.
+# Query vectors are computed here, so workers don't need to load the spacy model.
+def get_openai_messages_parallel(dataset: Dataset, hpo: HPO, system_message: str = None,
+                                 user_message_wrapper: str = None, assistant_message_table_header: str = None,
+                                 include_response: bool = True, few_shot_dataset: Dataset = None, few_shot_k: int = 15,
+                                 few_shot_k_min: int = 3, hand_picked_dataset: Dataset = None,
+                                 max_prompt_tokens: int = None, prefix_stable: bool = False, seed: int = None,
+                                 workers: int = None, chunk_size: int = 64) -> List[dict]:
+    query_vectors = [None] * len(dataset.observations)
+    if few_shot_dataset is not None:
+        get_similarity_index(few_shot_dataset)
+        query_vectors = get_observation_vectors(dataset.observations)
+    
+    parameters = {
+        'system_message': system_message,
+        'user_message_wrapper': user_message_wrapper,
+        'assistant_message_table_header': assistant_message_table_header,
+        'include_response': include_response,
+        'few_shot_k': few_shot_k,
+        'few_shot_k_min': few_shot_k_min,
+        'max_prompt_tokens': max_prompt_tokens,
+        'prefix_stable': prefix_stable,
+        'seed': seed
+    }
+    chunk_starts = range(0, len(dataset.observations), chunk_size)
+    messages = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_openai_messages_worker,
+                             initargs=(hpo, few_shot_dataset, hand_picked_dataset, parameters)) as executor, \
+         tqdm(total=len(dataset.observations)) as progress_bar:
+        chunks = executor.map(get_openai_messages_chunk,
+                              [dataset.observations[start:start + chunk_size] for start in chunk_starts],
+                              [query_vectors[start:start + chunk_size] for start in chunk_starts])
+        for chunk in chunks:
+            messages.extend(chunk)
+            progress_bar.update(len(chunk))
+    return messages
+
+# Token count of each prompt, e.g. to tune max_prompt_tokens
+def get_prompt_token_counts(list_of_messages: List[List[dict]]) -> List[int]:
+    return num_tokens_from_messages_batch(list_of_messages)
+
+# Request order grouping observations by body location, in order of first appearance.
+# Consecutive prompts then share their prefix, see prefix_stable.
+def get_bodyloc_request_order(dataset: Dataset) -> List[int]:
+    bodyloc_order = {}
+    for observation in dataset.observations:
+        bodyloc_order.setdefault(observation.bodyloc, len(bodyloc_order))
+    return sorted(range(len(dataset.observations)), key=lambda index: bodyloc_order[dataset.observations[index].bodyloc])
+
+# Tokens of each prompt in the longest message prefix shared with a prompt sent before it,
+# i.e. the tokens a provider's prompt cache can serve. Prompts are sent in order when given.
+def get_shared_prefix_token_counts(list_of_messages: List[List[dict]], order: List[int] = None) -> List[int]:
+    if order is None:
+        order = range(len(list_of_messages))
+    shared_prefix_token_counts = [0] * len(list_of_messages)
+    # Trie of sent prompts, one level per message
+    prefix_trie = {}
+    for index in order:
+        node = prefix_trie
+        shared = True
+        for message in list_of_messages[index]:
+            key = tuple(sorted(message.items()))
+            if shared and key in node:
+                shared_prefix_token_counts[index] += num_tokens_from_messages([message]) - 3
+            else:
+                shared = False
+            node = node.setdefault(key, {})
+    return shared_prefix_token_counts
+
 # Generate list to use as input for OpenAI GPT 3.5 Pretraining.
 # Uses a HPO object to get preferred terms for observed hpo concepts.
 def get_openai_finetuning_messages(dataset: Dataset, include_response: bool = True, hpo = None,
@@ -127,42 +359,21 @@ def get_openai_finetuning_messages(dataset: Dataset, include_response: bool = Tr
         
         if system_message:
             messages.append({'role': 'system', 'content': system_message})
-        # User input it observation text only
-        user_message = observation.text
-        if user_message_wrapper is not None:
-            user_message = user_message_wrapper % user_message
-        messages.append({'role': 'user', 'content': user_message})
-
+        
         if include_response:
-            if len(observation.terms) > 0:
-                # Build assistant response from terms
-                assistant_messages_per_term = []
-                for term in observation.terms:
-                    concept = hpo.get_concept_by_hpo_id(term.hpo_id)
-                    preferred_term = concept.get_preferred_term()
-                    assistant_message_for_term = ' | '.join([
-                        preferred_term,
-                        #term.hpo_id,
-                        #'X' if term.polarity else 'T',
-                        #'Absent' if term.polarity else 'Present',
-                        term.get_tagged_text(),
-                    ])
-                    assistant_message_for_term = '| %s |' % assistant_message_for_term
-                    assistant_messages_per_term.append(assistant_message_for_term)
-                
-                if assistant_message_table_header:
-                    assistant_message = '%s\n%s' % (assistant_message_table_header, '\n'.join(assistant_messages_per_term))
-                else:
-                    assistant_message = '\n'.join(assistant_messages_per_term)
-            else:
-                # No terms for an observation
-                # assistant_message = '| NA | NA |'
-                assistant_message = EMPTY_RESPONSE_MESSAGE
-            messages.append({'role': 'assistant', 'content': assistant_message})
+            # Same messages as the few shot examples of an observation
+            messages.extend(get_few_shot_messages(observation, hpo, user_message_wrapper, assistant_message_table_header))
+        else:
+            # User input it observation text only
+            user_message = observation.text
+            if user_message_wrapper is not None:
+                user_message = user_message_wrapper % user_message
+            messages.append({'role': 'user', 'content': user_message})
 
         openai_dataset.append({'messages': messages})
     
     if filename is not None:
+        os.makedirs(FINE_TUNE_DIR, exist_ok=True)
         save_to_jsonl(openai_dataset, os.path.join(FINE_TUNE_DIR, filename))
 
     return openai_dataset
\ No newline at end of file
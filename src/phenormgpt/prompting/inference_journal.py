@@ -0,0 +1,141 @@
+# Append-only journal of inference responses, written as each response arrives.
+# A crashed or interrupted run resumes from the journal and only requests the missing items.
+
+import hashlib
+import json
+import os
+import threading
+from typing import Iterator, List
+
+from prompting.openai_client import OpenAIClient
+
+def get_prompt_hash(messages: List[dict]) -> str:
+    prompt = json.dumps(messages, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+
+class InferenceJournal:
+    def __init__(self, filepath: str, fsync: bool = False):
+        self.filepath = filepath
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        # Observation index -> (prompt hash, offset of the entry in the journal).
+        # Entries themselves stay on disk.
+        self.entries = {}
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.filepath):
+            return
+        size = os.path.getsize(self.filepath)
+        offset = 0
+        with open(self.filepath, 'rb') as file:
+            for line in file:
+                entry = None
+                if line.endswith(b'\n'):
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        pass
+                if entry is not None:
+                    self.entries[entry['index']] = (entry['prompt_hash'], offset)
+                elif offset + len(line) == size:
+                    # Partial line from a crash while writing, drop it
+                    break
+                else:
+                    # Entries after a corrupt line are still valid
+                    print('Warning: Skipping corrupt journal entry at offset %d.' % offset)
+                offset += len(line)
+        if offset < size:
+            print('Warning: Dropping incomplete journal entry at offset %d.' % offset)
+            with open(self.filepath, 'r+b') as file:
+                file.truncate(offset)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def is_completed(self, index: int, prompt_hash: str) -> bool:
+        return index in self.entries and self.entries[index][0] == prompt_hash
+
+    def append(self, index: int, prompt_hash: str, observation: str, response: str):
+        line = json.dumps({
+            'index': index,
+            'prompt_hash': prompt_hash,
+            'observation': observation,
+            'response': response
+        }, ensure_ascii=False) + '\n'
+        with self.lock:
+            directory = os.path.dirname(self.filepath)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.filepath, 'ab') as file:
+                offset = file.tell()
+                file.write(line.encode('utf-8'))
+                file.flush()
+                if self.fsync:
+                    os.fsync(file.fileno())
+            self.entries[index] = (prompt_hash, offset)
+
+    # Requests every item that isn't in the journal yet, journaling responses as they arrive.
+    # Items whose prompt changed since they were journaled are requested again.
+    # Items are requested in order when given, e.g. get_bodyloc_request_order.
+    # Returns failed items as index -> exception, they can be retried with another run.
+    def run(self, openai_client: OpenAIClient, list_of_messages: List[List[dict]],
+            max_concurrency: int = 8, order: List[int] = None) -> dict:
+        if order is None:
+            order = range(len(list_of_messages))
+        pending = []
+        for index in order:
+            messages = list_of_messages[index]
+            prompt_hash = get_prompt_hash(messages)
+            if not self.is_completed(index, prompt_hash):
+                pending.append((index, prompt_hash))
+        print('Resuming inference: %d of %d items completed, %d to go.' % \
+              (len(list_of_messages) - len(pending), len(list_of_messages), len(pending)))
+
+        errors = {}
+        pending_messages = (list_of_messages[index] for index, _ in pending)
+        for i, response in openai_client.iter_responses(pending_messages, max_concurrency):
+            index, prompt_hash = pending[i]
+            if isinstance(response, Exception):
+                errors[index] = response
+                continue
+            observation = list_of_messages[index][-1]['content']
+            self.append(index, prompt_hash, observation, response)
+
+        if len(errors) > 0:
+            print('Warning: %d items failed, run again to retry them.' % len(errors))
+        return errors
+
+    def get_missing_indices(self, num_items: int) -> List[int]:
+        return [index for index in range(num_items) if index not in self.entries]
+
+    # Yields {observation, response} items in index order, reading one entry at a time.
+    # Entries are checked against the prompts of list_of_messages when given, so a journal
+    # reused after the prompts or the dataset changed doesn't yield stale responses.
+    def iter_responses(self, num_items: int = None, list_of_messages: List[List[dict]] = None) -> Iterator[dict]:
+        if num_items is None:
+            if list_of_messages is not None:
+                num_items = len(list_of_messages)
+            else:
+                num_items = max(self.entries.keys(), default=-1) + 1
+        with open(self.filepath, 'rb') as file:
+            for index in range(num_items):
+                if index not in self.entries:
+                    raise KeyError('Missing journal entry for item %d.' % index)
+                if list_of_messages is not None and \
+                        self.entries[index][0] != get_prompt_hash(list_of_messages[index]):
+                    raise KeyError('Journal entry for item %d is for another prompt.' % index)
+                file.seek(self.entries[index][1])
+                entry = json.loads(file.readline())
+                yield {'observation': entry['observation'], 'response': entry['response']}
+
+    # Writes the [{observation, response}] list read by init_dataset_from_openai_responses.
+    # Pass the list_of_messages given to run, to check every entry answers its current prompt.
+    def export(self, filepath: str, num_items: int = None, list_of_messages: List[List[dict]] = None):
+        with open(filepath, 'w') as file:
+            file.write('[')
+            for i, item in enumerate(self.iter_responses(num_items, list_of_messages)):
+                if i > 0:
+                    file.write(', ')
+                file.write(json.dumps(item))
+            file.write(']')
@@ -0,0 +1,164 @@
+# Offline inference with the OpenAI Batch API.
+# Messages are exported as batch request JSONL shards, and the result files are joined back by custom_id.
+# Missing or failed items can be exported again for resubmission.
+
+import glob
+import json
+import os
+from typing import Iterator, List, Tuple
+
+from prompting.inference_journal import get_prompt_hash
+from prompting.openai_client import SAMPLING_PARAMETERS
+
+BATCH_ENDPOINT = '/v1/chat/completions'
+BATCH_MAX_LINES = 50_000
+BATCH_MAX_BYTES = 200 * 1024 * 1024
+BATCH_MANIFEST_FILENAME = 'batch_manifest.json'
+
+# Custom IDs hold the item index and the prompt hash, so results of changed prompts aren't used.
+def get_custom_id(index: int, messages: List[dict]) -> str:
+    return 'item-%d-%s' % (index, get_prompt_hash(messages)[:16])
+
+def parse_custom_id(custom_id: str) -> Tuple[int, str]:
+    _, index, prompt_hash = custom_id.split('-')
+    return int(index), prompt_hash
+
+def get_batch_request(custom_id: str, messages: List[dict], model: str, sampling_parameters: dict) -> dict:
+    return {
+        'custom_id': custom_id,
+        'method': 'POST',
+        'url': BATCH_ENDPOINT,
+        'body': {'model': model, 'messages': messages, **sampling_parameters}
+    }
+
+# Writes batch request shards of at most max_lines requests and max_bytes bytes to directory,
+# along with a manifest of the custom IDs in each shard. Only exports the items at indices when given.
+# Returns the shard filepaths.
+def export_batch_requests(list_of_messages: List[List[dict]], directory: str, model: str = 'gpt-3.5-turbo-0613',
+                          sampling_parameters: dict = SAMPLING_PARAMETERS, indices: List[int] = None,
+                          max_lines: int = BATCH_MAX_LINES, max_bytes: int = BATCH_MAX_BYTES) -> List[str]:
+    os.makedirs(directory, exist_ok=True)
+    if indices is None:
+        indices = range(len(list_of_messages))
+
+    shards = []
+    file = None
+    for index in indices:
+        custom_id = get_custom_id(index, list_of_messages[index])
+        line = json.dumps(get_batch_request(custom_id, list_of_messages[index], model, sampling_parameters),
+                          ensure_ascii=False) + '\n'
+        line = line.encode('utf-8')
+        if len(line) > max_bytes:
+            print('Error: Request for item %d is larger than the shard size limit, skipping.' % index)
+            continue
+
+        # Start a new shard once the current one is full
+        if file is None or shards[-1]['num_items'] >= max_lines or shards[-1]['size'] + len(line) > max_bytes:
+            if file is not None:
+                file.close()
+            filename = 'batch_requests_%03d.jsonl' % len(shards)
+            file = open(os.path.join(directory, filename), 'wb')
+            shards.append({'filename': filename, 'num_items': 0, 'size': 0, 'custom_ids': []})
+        file.write(line)
+        shards[-1]['num_items'] += 1
+        shards[-1]['size'] += len(line)
+        shards[-1]['custom_ids'].append(custom_id)
+    if file is not None:
+        file.close()
+
+    num_items = sum([shard['num_items'] for shard in shards])
+    manifest = {
+        'model': model,
+        'num_items': num_items,
+        'sampling_parameters': sampling_parameters,
+        'shards': shards
+    }
+    with open(os.path.join(directory, BATCH_MANIFEST_FILENAME), 'w') as file:
+        json.dump(manifest, file)
+
+    print('Exported %d requests in %d shards to %s.' % (num_items, len(shards), directory))
+    return [os.path.join(directory, shard['filename']) for shard in shards]
+
+# Result and error files can be passed in any order, directories are searched for JSONL files.
+def get_batch_result_filepaths(paths: List[str]) -> List[str]:
+    filepaths = []
+    for path in paths:
+        if os.path.isdir(path):
+            filepaths.extend(sorted(glob.glob(os.path.join(path, '*.jsonl'))))
+        else:
+            filepaths.append(path)
+    return filepaths
+
+# Yields (custom_id, response, error) for every line of the result files, response is None for failed items.
+def iter_batch_results(paths: List[str]) -> Iterator[Tuple[str, str, str]]:
+    for filepath in get_batch_result_filepaths(paths):
+        with open(filepath, 'r', encoding='utf-8') as file:
+            for line_number, line in enumerate(file):
+                if len(line.strip()) == 0:
+                    continue
+                try:
+                    result = json.loads(line)
+                    custom_id = result['custom_id']
+                except (ValueError, KeyError):
+                    print('Error: Can\'t parse line %d of %s.' % (line_number + 1, filepath))
+                    continue
+
+                response = result.get('response')
+                error = result.get('error')
+                if error is None and response is not None and response.get('status_code') == 200:
+                    try:
+                        yield custom_id, response['body']['choices'][0]['message']['content'], None
+                    except (KeyError, IndexError, TypeError):
+                        yield custom_id, None, 'Unexpected response body.'
+                    continue
+                if error is None and response is not None:
+                    error = response.get('body', {}).get('error', 'Status code %s.' % response.get('status_code'))
+                yield custom_id, None, json.dumps(error) if not isinstance(error, str) else error
+
+# Joins batch results with the messages they were made for.
+# Returns the responses in item order (None where missing or failed), the missing indices,
+# and failed items as index -> error. Successful results win over failed ones for the same item.
+def import_batch_results(list_of_messages: List[List[dict]],
+                         paths: List[str]) -> Tuple[List[str], List[int], dict]:
+    custom_ids = [get_custom_id(index, messages) for index, messages in enumerate(list_of_messages)]
+    responses = [None] * len(list_of_messages)
+    errors = {}
+    num_stale = 0
+
+    for custom_id, response, error in iter_batch_results(paths):
+        try:
+            index, _ = parse_custom_id(custom_id)
+        except ValueError:
+            print('Error: Unknown custom ID: %s.' % custom_id)
+            continue
+        if index >= len(custom_ids) or custom_ids[index] != custom_id:
+            # Result of a prompt that has changed since it was exported
+            num_stale += 1
+            continue
+        if response is not None:
+            responses[index] = response
+            errors.pop(index, None)
+        elif responses[index] is None:
+            errors[index] = error
+
+    missing_indices = [index for index, response in enumerate(responses) \
+                       if response is None and index not in errors]
+    if num_stale > 0:
+        print('Warning: Ignored %d results for outdated prompts.' % num_stale)
+    print('Imported %d of %d responses, %d missing and %d failed.' % \
+          (len(responses) - len(missing_indices) - len(errors), len(responses), len(missing_indices), len(errors)))
+    return responses, missing_indices, errors
+
+# Indices to export again with export_batch_requests
+def get_resubmission_indices(missing_indices: List[int], errors: dict) -> List[int]:
+    return sorted(set(missing_indices) | set(errors.keys()))
+
+# Writes the [{observation, response}] list read by init_dataset_from_openai_responses.
+# Every item needs a response, so observations stay aligned with the dataset.
+def save_batch_responses(filepath: str, list_of_messages: List[List[dict]], responses: List[str]):
+    num_missing = len([response for response in responses if response is None])
+    if num_missing > 0:
+        raise ValueError('%d items have no response, resubmit them first.' % num_missing)
+    with open(filepath, 'w') as file:
+        json.dump([{'observation': messages[-1]['content'], 'response': response} \
+                   for messages, response in zip(list_of_messages, responses)], file)
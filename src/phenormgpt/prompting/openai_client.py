@@ -1,113 +1,478 @@
+import hashlib
+import json
 import openai
+import threading
 import time
-from typing import List
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from tqdm import tqdm
+from typing import Iterable, Iterator, List, Optional, Tuple
 
 from prompting.openai_dataset_analysis import num_tokens_from_messages
+from util.caching import SQLiteCache, get_cache_filepath
 
 TOKEN_LIMIT = 8_000
+REQUEST_LIMIT = 3_500
 DURATION_LIMIT = 60 # seconds
+MAX_RETRIES = 5 # for errors other than rate limits
+
+SAMPLING_PARAMETERS = {
+    'temperature': 0,
+    'max_tokens': 1550,
+    'top_p': 0.01,
+    'frequency_penalty': 0,
+    'presence_penalty': 0
+}
 
 # Class for API use. Not only for requests...
+# Token counts start as a reservation and are reconciled with the actual usage.
 class Request:
     def __init__(self, token_count, request_time):
         self.token_count = token_count
         self.request_time = request_time
+        self.expired = False
     
-    def has_expired(self) -> bool:
-        time_passed = time.time() - self.request_time
+    def has_expired(self, current_time: float = None) -> bool:
+        if current_time is None:
+            current_time = time.monotonic()
+        time_passed = current_time - self.request_time
         return time_passed > DURATION_LIMIT
 
+# Sliding window over the last minute of requests, since Rate Limits are bound to last 60 seconds.
+# Requests are kept in submission order with a running token total, so updates are amortized O(1).
 class ApiKeyTracker:
-    def __init__(self):
-        self.requests = []
+    def __init__(self, token_limit: int = TOKEN_LIMIT, request_limit: int = REQUEST_LIMIT):
+        self.token_limit = token_limit
+        self.request_limit = request_limit
+        self.requests = deque()
+        self.tokens_used = 0
+        # Shared by concurrent requests, waiters are notified when tokens are given back
+        self.condition = threading.Condition(threading.RLock())
 
     def add_request(self, request: Request):
-        self.requests.append(request)
+        with self.condition:
+            self.requests.append(request)
+            self.tokens_used += request.token_count
     
     def remove_request(self, request: Request):
-        self.requests.remove(request)
+        with self.condition:
+            if not request.expired:
+                self.requests.remove(request)
+                request.expired = True
+                self.tokens_used -= request.token_count
+                self.condition.notify_all()
     
-    # Removes request older than a minute, since Rate Limits are bound to last 60 seconds.
-    def purge_requests(self):
-        current_time = time.time()
-        for request in self.requests:
-            if request.has_expired():
-                self.remove_request(request)
+    # Removes request older than a minute
+    def purge_requests(self, current_time: float = None):
+        if current_time is None:
+            current_time = time.monotonic()
+        with self.condition:
+            while len(self.requests) > 0 and self.requests[0].has_expired(current_time):
+                request = self.requests.popleft()
+                request.expired = True
+                self.tokens_used -= request.token_count
     
     def get_tokens_used(self) -> int:
-        total_tokens = 0
-        for request in self.requests:
-            total_tokens += request.token_count
-        return total_tokens
-           
-    # Waits until we are clear to submit a new request with specified number of tokens
-    def prepare_for_tokens(self, num_tokens: int):
-        while (self.get_tokens_used() + num_tokens) > TOKEN_LIMIT:
-            time.sleep(.1)
+        with self.condition:
+            self.purge_requests()
+            return self.tokens_used
+    
+    def get_requests_made(self) -> int:
+        with self.condition:
             self.purge_requests()
+            return len(self.requests)
+    
+    # Seconds until a request with specified number of tokens fits in the window, 0 if it fits now.
+    # A request larger than the token limit is let through once the window is empty.
+    def get_wait_time(self, num_tokens: int) -> float:
+        current_time = time.monotonic()
+        with self.condition:
+            self.purge_requests(current_time)
+            tokens_used = self.tokens_used
+            num_requests = len(self.requests)
+            wait_time = None
+            for request in self.requests:
+                if tokens_used + num_tokens <= self.token_limit and num_requests < self.request_limit:
+                    break
+                # Wait for the oldest request to leave the window
+                wait_time = request.request_time + DURATION_LIMIT - current_time
+                tokens_used -= request.token_count
+                num_requests -= 1
+        if wait_time is None:
+            return 0
+        return max(wait_time, 0) + .01
+    
+    # Reserves tokens if they fit in the window, returns the reservation or the time to wait
+    def try_reserve(self, num_tokens: int) -> Tuple[Optional[Request], float]:
+        with self.condition:
+            wait_time = self.get_wait_time(num_tokens)
+            if wait_time > 0:
+                return None, wait_time
+            request = Request(num_tokens, time.monotonic())
+            self.add_request(request)
+            return request, 0
+    
+    # Waits until we are clear to submit a new request with specified number of tokens, then reserves them
+    def reserve(self, num_tokens: int) -> Request:
+        with self.condition:
+            while True:
+                request, wait_time = self.try_reserve(num_tokens)
+                if request is not None:
+                    return request
+                self.condition.wait(wait_time)
+    
+    # Replaces the reserved token count with the actual one, e.g. 0 for failed requests
+    def reconcile(self, request: Request, token_count: int):
+        with self.condition:
+            if not request.expired:
+                self.tokens_used += token_count - request.token_count
+            request.token_count = token_count
+            self.condition.notify_all()
+    
+    def prepare_for_tokens(self, num_tokens: int) -> Request:
+        return self.reserve(num_tokens)
+    
+    # Fraction of the window still free, by the tighter of both limits
+    def get_headroom(self) -> float:
+        with self.condition:
+            self.purge_requests()
+            return 1 - max(self.tokens_used / self.token_limit, len(self.requests) / self.request_limit)
+
+# An API key or model deployment with its own quota.
+# Azure deployments are set with api_type, api_version and deployment_id.
+class Endpoint:
+    def __init__(self, api_key: str, api_base: str = None, model: str = None,
+                 api_type: str = None, api_version: str = None, deployment_id: str = None,
+                 token_limit: int = TOKEN_LIMIT, request_limit: int = REQUEST_LIMIT, name: str = None):
+        self.api_key = api_key
+        self.api_base = api_base
+        self.model = model
+        self.api_type = api_type
+        self.api_version = api_version
+        self.deployment_id = deployment_id
+        self.api_key_tracker = ApiKeyTracker(token_limit, request_limit)
+        if name is None:
+            name = deployment_id if deployment_id is not None else '...%s' % str(api_key)[-4:]
+        self.name = name
+        
+        # Rate limited endpoints are paused until this time
+        self.paused_until = 0
+        self.consecutive_rate_limit_errors = 0
+        
+        # Usage statistics
+        self.num_requests = 0
+        self.num_tokens = 0
+        self.num_rate_limit_errors = 0
+        self.num_errors = 0
+    
+    # Parameters for openai.ChatCompletion.create
+    def get_request_parameters(self) -> dict:
+        request_parameters = {'api_key': self.api_key}
+        if self.api_base is not None:
+            request_parameters['api_base'] = self.api_base
+        if self.api_type is not None:
+            request_parameters['api_type'] = self.api_type
+        if self.api_version is not None:
+            request_parameters['api_version'] = self.api_version
+        if self.deployment_id is not None:
+            request_parameters['deployment_id'] = self.deployment_id
+        return request_parameters
+    
+    def is_paused(self, current_time: float = None) -> bool:
+        if current_time is None:
+            current_time = time.monotonic()
+        return current_time < self.paused_until
+    
+    def get_utilisation(self) -> dict:
+        tracker = self.api_key_tracker
+        return {
+            'name': self.name,
+            'requests': self.num_requests,
+            'tokens': self.num_tokens,
+            'rate_limit_errors': self.num_rate_limit_errors,
+            'errors': self.num_errors,
+            'tpm': tracker.get_tokens_used() / tracker.token_limit,
+            'rpm': tracker.get_requests_made() / tracker.request_limit,
+            'paused': self.is_paused()
+        }
+
+# Endpoints from dicts of Endpoint arguments, e.g. openai_endpoints in config.openai_config
+def init_endpoints(endpoint_configs: List[dict]) -> List[Endpoint]:
+    return [Endpoint(**endpoint_config) for endpoint_config in endpoint_configs]
+
+# Routes each request to the endpoint with the most headroom.
+# An endpoint is paused for pause_seconds after a RateLimitError,
+# and drained for drain_seconds after drain_after of them in a row.
+class EndpointPool:
+    def __init__(self, endpoints: List[Endpoint], pause_seconds: float = 10, drain_after: int = 3,
+                 drain_seconds: float = DURATION_LIMIT):
+        assert(len(endpoints) > 0)
+        self.endpoints = endpoints
+        self.pause_seconds = pause_seconds
+        self.drain_after = drain_after
+        self.drain_seconds = drain_seconds
+        # Waiters are notified when an endpoint gives back tokens
+        self.condition = threading.Condition()
+    
+    # Waits until an endpoint can take a request with specified number of tokens, then reserves them
+    def acquire(self, num_tokens: int) -> Tuple[Endpoint, Request]:
+        with self.condition:
+            while True:
+                current_time = time.monotonic()
+                wait_times = []
+                endpoints = []
+                for endpoint in self.endpoints:
+                    if endpoint.is_paused(current_time):
+                        wait_times.append(endpoint.paused_until - current_time)
+                    else:
+                        endpoints.append(endpoint)
                 
+                endpoints.sort(key=lambda endpoint: -endpoint.api_key_tracker.get_headroom())
+                for endpoint in endpoints:
+                    request, wait_time = endpoint.api_key_tracker.try_reserve(num_tokens)
+                    if request is not None:
+                        endpoint.num_requests += 1
+                        return endpoint, request
+                    wait_times.append(wait_time)
+                self.condition.wait(min(wait_times))
+    
+    # Reconciles the reservation with the tokens used, 0 for failed requests
+    def release(self, endpoint: Endpoint, request: Request, token_count: int = 0):
+        endpoint.api_key_tracker.reconcile(request, token_count)
+        with self.condition:
+            endpoint.num_tokens += token_count
+            if token_count > 0:
+                endpoint.consecutive_rate_limit_errors = 0
+            self.condition.notify_all()
+    
+    # Gives back a request that wasn't sent, e.g. answered from the cache
+    def cancel(self, endpoint: Endpoint, request: Request):
+        endpoint.api_key_tracker.remove_request(request)
+        with self.condition:
+            endpoint.num_requests -= 1
+            self.condition.notify_all()
+    
+    def report_rate_limit(self, endpoint: Endpoint, request: Request):
+        endpoint.api_key_tracker.reconcile(request, 0)
+        with self.condition:
+            endpoint.num_rate_limit_errors += 1
+            endpoint.consecutive_rate_limit_errors += 1
+            if endpoint.consecutive_rate_limit_errors >= self.drain_after:
+                pause_seconds = self.drain_seconds
+                endpoint.consecutive_rate_limit_errors = 0
+                print('Warning: Draining endpoint %s for %d seconds.' % (endpoint.name, pause_seconds))
+            else:
+                pause_seconds = self.pause_seconds
+            endpoint.paused_until = max(endpoint.paused_until, time.monotonic() + pause_seconds)
+            self.condition.notify_all()
+    
+    def report_error(self, endpoint: Endpoint, request: Request):
+        with self.condition:
+            endpoint.num_errors += 1
+        self.release(endpoint, request, 0)
+    
+    def get_utilisation(self) -> List[dict]:
+        return [endpoint.get_utilisation() for endpoint in self.endpoints]
+    
+    def print_utilisation(self):
+        print('Endpoint\tRequests\tTokens\tRate Limit Errors\tErrors\tTPM\tRPM\tPaused')
+        for utilisation in self.get_utilisation():
+            print('%s\t%d\t%d\t%d\t%d\t%.0f%%\t%.0f%%\t%s' % (
+                utilisation['name'], utilisation['requests'], utilisation['tokens'],
+                utilisation['rate_limit_errors'], utilisation['errors'],
+                utilisation['tpm'] * 100, utilisation['rpm'] * 100, utilisation['paused']))
+                
+RESPONSE_CACHE_FILENAME = 'openai_responses.sqlite'
+
+# Responses are cached by model, messages and sampling parameters
+def get_response_cache_key(model: str, messages: List[dict], sampling_parameters: dict) -> str:
+    request = json.dumps({'model': model, 'messages': messages, 'sampling_parameters': sampling_parameters},
+                         sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(request.encode('utf-8')).hexdigest()
+
+def get_response_cache(read_only: bool = False, max_size: int = 1 << 30, filepath: str = None) -> SQLiteCache:
+    if filepath is None:
+        filepath = get_cache_filepath(RESPONSE_CACHE_FILENAME)
+    return SQLiteCache(filepath, max_size=max_size, read_only=read_only)
+
+class BatchResponseError(Exception):
+    def __init__(self, responses: List[str], errors: dict):
+        super().__init__('%d of %d requests failed.' % (len(errors), len(responses)))
+        self.responses = responses # None for failed requests
+        self.errors = errors # Index -> exception
+
 class OpenAIClient:
-    def __init__(self, api_key: str, model: str = "gpt-3.5-turbo-0613", debug: bool = True):
+    # api_base can point to any OpenAI compatible server, e.g. a local stub for testing.
+    # Identical requests are answered from response_cache when given, see get_response_cache.
+    # Requests are spread over endpoints when given, each with its own quota, see init_endpoints.
+    # Requests failing with errors other than rate limits are retried up to max_retries times.
+    def __init__(self, api_key: str, model: str = "gpt-3.5-turbo-0613", debug: bool = True,
+                 api_base: str = None, response_cache: SQLiteCache = None,
+                 token_limit: int = TOKEN_LIMIT, request_limit: int = REQUEST_LIMIT,
+                 endpoints: List[Endpoint] = None, max_retries: int = MAX_RETRIES):
         self.api_key = api_key
-        openai.api_key = api_key
-        self.api_key_tracker = ApiKeyTracker()
+        if api_key is not None:
+            openai.api_key = api_key
+        self.api_base = api_base
+        if not endpoints:
+            endpoints = [Endpoint(api_key, api_base, token_limit=token_limit, request_limit=request_limit)]
+        self.endpoint_pool = EndpointPool(endpoints)
+        self.api_key_tracker = endpoints[0].api_key_tracker
         self.model = model
+        self.sampling_parameters = dict(SAMPLING_PARAMETERS)
+        self.response_cache = response_cache
+        self.max_retries = max_retries
         self.debug = debug
-         
+    
+    # Endpoints can serve their own model instead of the client's
+    def get_model(self, endpoint: Endpoint) -> str:
+        return endpoint.model if endpoint.model is not None else self.model
+    
+    # Model of every endpoint, or None if endpoints serve different models
+    def get_pool_model(self) -> str:
+        models = set([self.get_model(endpoint) for endpoint in self.endpoint_pool.endpoints])
+        return models.pop() if len(models) == 1 else None
+    
+    def create_chat_completion(self, messages: List[dict], endpoint: Endpoint = None) -> dict:
+        if endpoint is None:
+            endpoint = self.endpoint_pool.endpoints[0]
+        request_parameters = endpoint.get_request_parameters()
+        if request_parameters['api_key'] is None:
+            request_parameters.pop('api_key')
+        return openai.ChatCompletion.create(
+            model=self.get_model(endpoint),
+            messages=messages,
+            **self.sampling_parameters,
+            **request_parameters
+        )
+    
+    # Raises openai.error.InvalidRequestError for requests that can't succeed.
+    # Responses are cached by the model of the endpoint that answered them. If all endpoints serve
+    # the same model, the cache is checked before waiting for quota, otherwise once an endpoint is chosen.
     def get_response(self, messages: List[dict]) -> str:
         
+        pool_model = self.get_pool_model()
+        if self.response_cache is not None and pool_model is not None:
+            answer = self.response_cache.get(get_response_cache_key(pool_model, messages, self.sampling_parameters))
+            if answer is not None:
+                return answer
+        
         num_tokens = num_tokens_from_messages(messages)
         if self.debug:
             print('Request tokens: %d.' % int(num_tokens))
-            
-        self.api_key_tracker.prepare_for_tokens(num_tokens)
         
-        if self.debug:
-            print('TPM: %d.' % self.api_key_tracker.get_tokens_used())
+        # Completion tokens count against the limit too, so reserve the most the response can use
+        reserved_tokens = num_tokens + self.sampling_parameters['max_tokens']
         
+        num_retries = 0
         awaiting_response = True
         while awaiting_response:
+            endpoint, request = self.endpoint_pool.acquire(reserved_tokens)
+            if self.debug:
+                print('TPM: %d (%s).' % (endpoint.api_key_tracker.get_tokens_used(), endpoint.name))
+            if self.response_cache is not None and pool_model is None:
+                answer = self.response_cache.get(get_response_cache_key(self.get_model(endpoint), messages,
+                                                                         self.sampling_parameters))
+                if answer is not None:
+                    self.endpoint_pool.cancel(endpoint, request)
+                    return answer
+            
+            # Failed requests don't use tokens
             try:
                 #print('Sending request to OpenAI API...')
-                response = openai.ChatCompletion.create(
-                    model=self.model,
-                    messages=messages,
-                    temperature=0,
-                    max_tokens=1550,
-                    top_p=0.01,
-                    frequency_penalty=0,
-                    presence_penalty=0
-                )
+                response = self.create_chat_completion(messages, endpoint)
                 #print('Response received.')
                 awaiting_response = False
             except openai.error.RateLimitError as e:
+                # Retried once the endpoint is unpaused, or on another endpoint
                 print('Encountered RateLimitError, retrying...')
                 print(e)
-                time.sleep(10)
+                self.endpoint_pool.report_rate_limit(endpoint, request)
             except openai.error.InvalidRequestError as e:
                 print('Encountered InvalidRequestError, stopping...')
                 print(messages)
                 print(e)
-                exit()
+                self.endpoint_pool.report_error(endpoint, request)
+                raise
             except Exception as e:
+                self.endpoint_pool.report_error(endpoint, request)
+                if num_retries >= self.max_retries:
+                    print('Encountered exception after %d retries, stopping...' % num_retries)
+                    print(e)
+                    raise
                 print('Encountered exception, retrying...')
                 print(e)
+                num_retries += 1
                 time.sleep(5)
+            except BaseException:
+                self.endpoint_pool.release(endpoint, request, 0)
+                raise
         
         total_tokens = response['usage']['total_tokens']
         if self.debug:
             print('Total tokens: %d.' % int(total_tokens))
         
-        '''
-        response_tokens = response['usage']['completion_tokens'] 
-        response_request = Request(response_tokens, time.time())
-        '''
-        response_request = Request(total_tokens, time.time())
-        self.api_key_tracker.add_request(response_request)
+        self.endpoint_pool.release(endpoint, request, total_tokens)
         
         answer = response['choices'][0]['message']['content']
+        if self.response_cache is not None:
+            self.response_cache.set(get_response_cache_key(self.get_model(endpoint), messages, self.sampling_parameters),
+                                    answer)
         return answer
     
+    # Runs requests concurrently, yielding (index, answer) pairs as they complete.
+    # Failed requests yield their exception instead of an answer. Messages are consumed lazily,
+    # with at most max_concurrency requests in flight. All requests share the token budget.
+    def iter_responses(self, list_of_messages: Iterable[List[dict]],
+                       max_concurrency: int = 8) -> Iterator[Tuple[int, str]]:
+        list_of_messages = iter(enumerate(list_of_messages))
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            futures = {}
+            exhausted = False
+            while True:
+                while not exhausted and len(futures) < max_concurrency:
+                    try:
+                        index, messages = next(list_of_messages)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    futures[executor.submit(self.get_response, messages)] = index
+                if len(futures) == 0:
+                    break
+                
+                done, _ = wait(futures.keys(), return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = futures.pop(future)
+                    try:
+                        yield index, future.result()
+                    except Exception as e:
+                        yield index, e
+    
+    def get_utilisation(self) -> List[dict]:
+        return self.endpoint_pool.get_utilisation()
+    
+    def print_utilisation(self):
+        self.endpoint_pool.print_utilisation()
+    
+    # Batch version of get_response, answers are in input order.
+    # Failures raise a BatchResponseError holding the successful answers,
+    # or are returned in place of the answer with return_exceptions.
+    def get_responses(self, list_of_messages: List[List[dict]], max_concurrency: int = 8,
+                      return_exceptions: bool = False, progress: bool = True) -> List[str]:
+        responses = [None] * len(list_of_messages)
+        errors = {}
+        for index, response in tqdm(self.iter_responses(list_of_messages, max_concurrency),
+                                    total=len(list_of_messages), disable=not progress):
+            if isinstance(response, Exception):
+                errors[index] = response
+                if not return_exceptions:
+                    continue
+            responses[index] = response
+        
+        if len(errors) > 0 and not return_exceptions:
+            raise BatchResponseError(responses, errors)
+        return responses
+    
 class FinetuningOpenAIClient(OpenAIClient):
     def __init__(self, api_key: str, model: str = "gpt-3.5-turbo-0613", debug: bool = True):
         super().__init__(api_key, model, debug)
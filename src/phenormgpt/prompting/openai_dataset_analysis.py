@@ -1,7 +1,12 @@
+import hashlib
 import json
+import threading
 import tiktoken
 import numpy as np
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from typing import List
+
+from util.lazy import LazyValue
 
 def view_dataset(dataset: dict):
     # Initial dataset stats
@@ -49,7 +54,93 @@ def check_errors(dataset: dict):
         print("No errors found")
 
 # Token counting functions
-encoding = tiktoken.get_encoding("cl100k_base")
+lazy_encoding = LazyValue(lambda: tiktoken.get_encoding("cl100k_base"))
+
+def get_encoding():
+    return lazy_encoding.get()
+
+def __getattr__(name: str):
+    if name == 'encoding':
+        return get_encoding()
+    raise AttributeError('module %s has no attribute %s' % (__name__, name))
+
+# Token counts of strings, least recently used counts are evicted after max_size entries.
+# System messages, few shot examples and table headers repeat across prompts, so most lookups are hits.
+# Keyed by content hash, so long strings aren't kept in memory.
+class TokenCountCache:
+    def __init__(self, max_size: int = 2**17):
+        self.max_size = max_size
+        self.counts = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+    
+    @staticmethod
+    def get_key(text: str) -> bytes:
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+    
+    def lookup(self, key: bytes) -> int:
+        with self.lock:
+            count = self.counts.get(key)
+            if count is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.counts.move_to_end(key)
+            return count
+    
+    def store(self, key: bytes, count: int):
+        with self.lock:
+            self.counts[key] = count
+            self.counts.move_to_end(key)
+            while len(self.counts) > self.max_size:
+                self.counts.popitem(last=False)
+    
+    def count(self, text: str) -> int:
+        key = self.get_key(text)
+        count = self.lookup(key)
+        if count is None:
+            count = len(get_encoding().encode(text))
+            self.store(key, count)
+        return count
+    
+    # Counts uncached strings with a single batch encode
+    def count_batch(self, texts: List[str]) -> List[int]:
+        keys = [self.get_key(text) for text in texts]
+        counts = {}
+        uncached = {}
+        for key, text in zip(keys, texts):
+            if key in counts or key in uncached:
+                continue
+            count = self.lookup(key)
+            if count is None:
+                uncached[key] = text
+            else:
+                counts[key] = count
+        if len(uncached) > 0:
+            encodings = get_encoding().encode_batch(list(uncached.values()))
+            for key, encoded in zip(uncached.keys(), encodings):
+                counts[key] = len(encoded)
+                self.store(key, counts[key])
+        return [counts[key] for key in keys]
+    
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.counts)}
+    
+    def clear(self):
+        with self.lock:
+            self.counts.clear()
+            self.hits = 0
+            self.misses = 0
+
+token_count_cache = TokenCountCache()
+
+def num_tokens_from_string(text: str) -> int:
+    return token_count_cache.count(text)
+
+def num_tokens_from_strings(texts: List[str]) -> List[int]:
+    return token_count_cache.count_batch(texts)
 
 # not exact!
 # simplified from https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
@@ -58,19 +149,43 @@ def num_tokens_from_messages(messages, tokens_per_message=3, tokens_per_name=1):
     for message in messages:
         num_tokens += tokens_per_message
         for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
+            num_tokens += num_tokens_from_string(value)
             if key == "name":
                 num_tokens += tokens_per_name
     num_tokens += 3
     return num_tokens
 
+# Same counts as num_tokens_from_messages, for many prompts at once
+def num_tokens_from_messages_batch(list_of_messages, tokens_per_message=3, tokens_per_name=1) -> List[int]:
+    values = [value for messages in list_of_messages for message in messages for value in message.values()]
+    value_counts = iter(num_tokens_from_strings(values))
+    counts = []
+    for messages in list_of_messages:
+        num_tokens = 0
+        for message in messages:
+            num_tokens += tokens_per_message
+            for key in message.keys():
+                num_tokens += next(value_counts)
+                if key == "name":
+                    num_tokens += tokens_per_name
+        num_tokens += 3
+        counts.append(num_tokens)
+    return counts
+
 def num_assistant_tokens_from_messages(messages):
     num_tokens = 0
     for message in messages:
         if message["role"] == "assistant":
-            num_tokens += len(encoding.encode(message["content"]))
+            num_tokens += num_tokens_from_string(message["content"])
     return num_tokens
 
+def num_assistant_tokens_from_messages_batch(list_of_messages) -> List[int]:
+    contents = [[message["content"] for message in messages if message["role"] == "assistant"] \
+                for messages in list_of_messages]
+    content_counts = iter(num_tokens_from_strings([content for message_contents in contents \
+                                                   for content in message_contents]))
+    return [sum([next(content_counts) for _ in message_contents]) for message_contents in contents]
+
 def print_distribution(values, name):
     print(f"\n#### Distribution of {name}:")
     print(f"min / max: {min(values)}, {max(values)}")
@@ -82,8 +197,6 @@ def view_token_counts(dataset: dict):
     n_missing_system = 0
     n_missing_user = 0
     n_messages = []
-    convo_lens = []
-    assistant_message_lens = []
 
     for ex in dataset:
         messages = ex["messages"]
@@ -92,8 +205,8 @@ def view_token_counts(dataset: dict):
         if not any(message["role"] == "user" for message in messages):
             n_missing_user += 1
         n_messages.append(len(messages))
-        convo_lens.append(num_tokens_from_messages(messages))
-        assistant_message_lens.append(num_assistant_tokens_from_messages(messages))
+    convo_lens = num_tokens_from_messages_batch([ex["messages"] for ex in dataset])
+    assistant_message_lens = num_assistant_tokens_from_messages_batch([ex["messages"] for ex in dataset])
 
     print("Num examples missing system message:", n_missing_system)
     print("Num examples missing user message:", n_missing_user)
@@ -120,10 +233,7 @@ def view_pricing_estimate(dataset: dict):
     elif n_train_examples * TARGET_EPOCHS > MAX_TARGET_EXAMPLES:
         n_epochs = max(MIN_DEFAULT_EPOCHS, MAX_TARGET_EXAMPLES // n_train_examples)
 
-    convo_lens = []
-    for ex in dataset:
-        messages = ex["messages"]
-        convo_lens.append(num_tokens_from_messages(messages))
+    convo_lens = num_tokens_from_messages_batch([ex["messages"] for ex in dataset])
     
     n_billing_tokens_in_dataset = sum(min(MAX_TOKENS_PER_EXAMPLE, length) for length in convo_lens)
     print(f"Dataset has ~{n_billing_tokens_in_dataset} tokens that will be charged for during training")
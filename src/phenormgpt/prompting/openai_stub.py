@@ -0,0 +1,209 @@
+# Local stub of the OpenAI chat completions API, to exercise the client and the batch workflow offline.
+# Answers echo the last message after a random delay, so concurrent requests complete out of order.
+# Markers in the last message inject failures:
+#   STUB_RATE_LIMIT: rate limited on the first attempt, answered on the next
+#   STUB_ERROR: server error on every attempt
+#   STUB_INVALID: invalid request
+# Run the checks from the src/phenormgpt directory:
+#   python -m prompting.openai_stub
+# Or serve the stub and point infer at it with --api-base http://127.0.0.1:8000/v1:
+#   python -m prompting.openai_stub --serve 8000
+
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Tuple
+
+import click
+
+STUB_RATE_LIMIT = 'STUB_RATE_LIMIT'
+STUB_ERROR = 'STUB_ERROR'
+STUB_INVALID = 'STUB_INVALID'
+STUB_MAX_DELAY = 0.05 # seconds
+
+def get_stub_answer(content: str) -> str:
+    return 'echo: %s' % content
+
+def get_stub_completion(model: str, content: str) -> dict:
+    return {
+        'id': 'chatcmpl-stub',
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': model,
+        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': get_stub_answer(content)},
+                     'finish_reason': 'stop'}],
+        'usage': {'prompt_tokens': 10, 'completion_tokens': 5, 'total_tokens': 15}
+    }
+
+def get_stub_error(content: str) -> Tuple[int, dict]:
+    if STUB_INVALID in content:
+        return 400, {'error': {'message': 'Invalid request.', 'type': 'invalid_request_error', 'param': None,
+                               'code': None}}
+    if STUB_ERROR in content:
+        return 500, {'error': {'message': 'Server error.', 'type': 'server_error', 'param': None, 'code': None}}
+    return None, None
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Contents already rate limited once, shared by all requests to the server
+    rate_limited = set()
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status_code: int, body: dict):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        if not self.path.endswith('/chat/completions'):
+            self.send_json(404, {'error': {'message': 'Unknown path %s.' % self.path, 'type': 'invalid_request_error',
+                                           'param': None, 'code': None}})
+            return
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        content = body['messages'][-1]['content']
+        time.sleep(random.random() * STUB_MAX_DELAY)
+
+        if STUB_RATE_LIMIT in content:
+            with self.lock:
+                first_attempt = content not in self.rate_limited
+                self.rate_limited.add(content)
+            if first_attempt:
+                self.send_json(429, {'error': {'message': 'Rate limit reached.', 'type': 'requests', 'param': None,
+                                               'code': 'rate_limit_exceeded'}})
+                return
+        status_code, error = get_stub_error(content)
+        if status_code is not None:
+            self.send_json(status_code, error)
+            return
+        self.send_json(200, get_stub_completion(body['model'], content))
+
+# Serves the stub in a background thread on port, any free port by default.
+# Returns the server, to shut down when done, and its API base URL.
+def start_stub_server(port: int = 0) -> Tuple[ThreadingHTTPServer, str]:
+    server = ThreadingHTTPServer(('127.0.0.1', port), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:%d/v1' % server.server_address[1]
+
+# Answers batch request shards like the Batch API would, as one result file.
+# Requests with failure markers get an error result, like a batch item that failed.
+def write_stub_batch_results(request_filepaths: List[str], filepath: str):
+    with open(filepath, 'w', encoding='utf-8') as result_file:
+        for request_filepath in request_filepaths:
+            with open(request_filepath, 'r', encoding='utf-8') as request_file:
+                for line in request_file:
+                    request = json.loads(line)
+                    content = request['body']['messages'][-1]['content']
+                    status_code, error = get_stub_error(content)
+                    if status_code is None:
+                        status_code, body = 200, get_stub_completion(request['body']['model'], content)
+                    else:
+                        body = error
+                    result = {
+                        'id': 'batch_req_stub',
+                        'custom_id': request['custom_id'],
+                        'response': {'status_code': status_code, 'body': body},
+                        'error': None
+                    }
+                    result_file.write(json.dumps(result, ensure_ascii=False) + '\n')
+
+def get_stub_messages(contents: List[str]) -> List[List[dict]]:
+    return [[{'role': 'system', 'content': 'Stub check.'}, {'role': 'user', 'content': content}] for content in contents]
+
+# Responses come back in input order, even though the stub answers them out of order
+def check_ordering(api_base: str):
+    from pipeline.streaming import iter_ordered_responses
+    from prompting.openai_client import OpenAIClient
+    openai_client = OpenAIClient('stub', debug=False, api_base=api_base)
+    contents = ['Observation %d' % i for i in range(50)]
+    prompts = ((content, messages) for content, messages in zip(contents, get_stub_messages(contents)))
+    results = list(iter_ordered_responses(openai_client, prompts, max_concurrency=8))
+    assert [content for content, _ in results] == contents
+    assert [response for _, response in results] == [get_stub_answer(content) for content in contents]
+    assert openai_client.get_responses(get_stub_messages(contents), progress=False) == \
+           [get_stub_answer(content) for content in contents]
+    print('Ordering: %d responses in input order.' % len(results))
+
+# Rate limits are retried, other errors up to max_retries times, then reported per item
+def check_retries(api_base: str):
+    from prompting.openai_client import BatchResponseError, OpenAIClient
+    openai_client = OpenAIClient('stub', debug=False, api_base=api_base, max_retries=1)
+    openai_client.endpoint_pool.pause_seconds = 0.1
+    contents = ['Observation 0', 'Observation 1 %s' % STUB_RATE_LIMIT, 'Observation 2 %s' % STUB_ERROR,
+                'Observation 3 %s' % STUB_INVALID]
+    try:
+        openai_client.get_responses(get_stub_messages(contents), progress=False)
+        raise AssertionError('Expected a BatchResponseError.')
+    except BatchResponseError as e:
+        assert e.responses[:2] == [get_stub_answer(content) for content in contents[:2]]
+        assert e.responses[2:] == [None, None]
+        assert sorted(e.errors.keys()) == [2, 3]
+    utilisation = openai_client.endpoint_pool.get_utilisation()[0]
+    # Rate limited and failing items are sent twice, the invalid request isn't retried
+    assert utilisation['requests'] == 6 and utilisation['rate_limit_errors'] == 1 and utilisation['errors'] == 3, \
+           utilisation
+    print('Retries: rate limit retried, errors reported after %d retries, BatchResponseError raised.' % \
+          openai_client.max_retries)
+
+# Batch requests are exported, answered, imported and failed items picked for resubmission
+def check_batch_round_trip():
+    from prompting.openai_batch import export_batch_requests, get_resubmission_indices, import_batch_results, \
+                                       save_batch_responses
+    contents = ['Observation %d' % i for i in range(10)]
+    contents[4] += ' %s' % STUB_ERROR
+    list_of_messages = get_stub_messages(contents)
+    with tempfile.TemporaryDirectory() as directory:
+        request_filepaths = export_batch_requests(list_of_messages, os.path.join(directory, 'requests'), max_lines=4)
+        assert len(request_filepaths) == 3
+        results_filepath = os.path.join(directory, 'results.jsonl')
+        write_stub_batch_results(request_filepaths[:2], results_filepath)
+        responses, missing_indices, errors = import_batch_results(list_of_messages, [results_filepath])
+        assert missing_indices == [8, 9] and list(errors.keys()) == [4]
+        resubmission_indices = get_resubmission_indices(missing_indices, errors)
+        assert resubmission_indices == [4, 8, 9]
+
+        # Resubmit with the failing item fixed
+        contents[4] = 'Observation 4'
+        list_of_messages = get_stub_messages(contents)
+        request_filepaths = export_batch_requests(list_of_messages, os.path.join(directory, 'resubmission'),
+                                                  indices=resubmission_indices)
+        write_stub_batch_results(request_filepaths, os.path.join(directory, 'resubmission_results.jsonl'))
+        responses, missing_indices, errors = import_batch_results(
+            list_of_messages, [results_filepath, os.path.join(directory, 'resubmission_results.jsonl')])
+        assert responses == [get_stub_answer(content) for content in contents]
+        save_batch_responses(os.path.join(directory, 'responses.json'), list_of_messages, responses)
+    print('Batch: exported, imported and resubmitted %d items.' % len(contents))
+
+@click.command()
+@click.option('--serve', 'port', type=int, default=None, help='Serve the stub on this port instead of running the checks.')
+def main(port: int):
+    """Check the OpenAI client and the batch workflow against a local stub."""
+    if port is not None:
+        server, api_base = start_stub_server(port)
+        print('Serving the OpenAI stub at %s, press Ctrl+C to stop.' % api_base)
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            server.shutdown()
+        return
+
+    server, api_base = start_stub_server()
+    try:
+        check_ordering(api_base)
+        check_retries(api_base)
+        check_batch_round_trip()
+    finally:
+        server.shutdown()
+    print('All stub checks passed.')
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,39 @@
-import spacy
+import hashlib
+import json
+import os
+import numpy as np
+from typing import List
+
 from base.dataset import Observation, Dataset
+from config.config import CACHE_DIR
+from util.lazy import LazyValue
+
+SIMILARITY_INDEX_DIR = os.path.join(CACHE_DIR, 'similarity_index')
+
+# Load spacy model for similarity calculations, on first use
+def load_model():
+    import spacy
+    try:
+        model = spacy.load('en_core_web_md')
+    except OSError:
+        from spacy.cli import download
+        download('en_core_web_md')
+        model = spacy.load('en_core_web_md')
+    return model
+
+lazy_model = LazyValue(load_model)
+
+def get_model():
+    return lazy_model.get()
+
+def __getattr__(name: str):
+    if name == 'model':
+        return get_model()
+    raise AttributeError('module %s has no attribute %s' % (__name__, name))
 
-# Import spacy model for similarity calculations
-try:
-    model = spacy.load('en_core_web_md')
-except OSError:
-    from spacy.cli import download
-    download('en_core_web_md')
-    model = spacy.load('en_core_web_md')
-    
 def get_observation_similarity_score(observation1: Observation,
                                      observation2: Observation) -> float:
+    model = get_model()
     doc1 = model(observation1.text)
     doc2 = model(observation2.text)
     return doc2.similarity(doc1)
@@ -34,4 +57,146 @@ def get_n_most_similar_observations(dataset: Dataset, observation: Observation,
                                                                                   observation)
     
     top_n_observations = list(dict(sorted(similarity_dict.items(), key=lambda x:-x[1])[:n]).keys())
-    return Dataset(top_n_observations)
\ No newline at end of file
+    return Dataset(top_n_observations)
+
+# Vectorized similarity search
+
+# Doc vectors only depend on the tokenizer and the static word vectors,
+# so the pipeline components are disabled while vectorizing.
+def get_text_vectors(texts: List[str], batch_size: int = 256) -> np.ndarray:
+    model = get_model()
+    vectors = np.zeros((len(texts), model.vocab.vectors_length), dtype=np.float32)
+    with model.select_pipes(enable=[]):
+        for i, doc in enumerate(model.pipe(texts, batch_size=batch_size)):
+            vectors[i] = doc.vector
+
+    # L2 normalize, so dot products are cosine similarities. Empty vectors score 0, as in spacy.
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+def get_observation_vectors(observations: List[Observation], batch_size: int = 256) -> np.ndarray:
+    return get_text_vectors([observation.text for observation in observations], batch_size)
+
+def get_dataset_fingerprint(dataset: Dataset) -> str:
+    fingerprint = hashlib.sha256()
+    for observation in dataset.observations:
+        fingerprint.update(('%s\t%s\t%d\n' % (observation.observation_id, observation.text,
+                                              observation.has_terms())).encode('utf-8'))
+    return fingerprint.hexdigest()
+
+# Retrieval index over a few shot dataset.
+# Rows are sorted by body location and then by has-terms/NA, so every partition
+# is a contiguous slice of the vector matrix.
+class SimilarityIndex:
+    def __init__(self, dataset: Dataset, vectors: np.ndarray = None, rows: np.ndarray = None):
+        self.dataset = dataset
+        self.fingerprint = get_dataset_fingerprint(dataset)
+
+        if rows is None:
+            rows = np.array(sorted(range(len(dataset.observations)),
+                                   key=lambda i: (dataset.observations[i].bodyloc,
+                                                  dataset.observations[i].has_terms())), dtype=np.int64)
+        if vectors is None:
+            vectors = get_observation_vectors([dataset.observations[i] for i in rows])
+        self.rows = rows # Matrix row -> dataset index
+        self.vectors = vectors
+
+        # (bodyloc, subset) -> matrix rows, a bodyloc of None searches all body locations
+        self.partitions = {(None, 'all'): slice(0, len(rows))}
+        self.text_rows = {}
+        terms_rows = []
+        na_rows = []
+        for row, index in enumerate(rows):
+            observation = dataset.observations[index]
+            self.text_rows.setdefault(observation.text, []).append(row)
+            subset = 'terms' if observation.has_terms() else 'na'
+            for key in [(observation.bodyloc, 'all'), (observation.bodyloc, subset)]:
+                if key in self.partitions:
+                    self.partitions[key] = slice(self.partitions[key].start, row + 1)
+                else:
+                    self.partitions[key] = slice(row, row + 1)
+            if subset == 'terms':
+                terms_rows.append(row)
+            else:
+                na_rows.append(row)
+        self.partitions[(None, 'terms')] = np.array(terms_rows, dtype=np.int64)
+        self.partitions[(None, 'na')] = np.array(na_rows, dtype=np.int64)
+
+    def get_query_vector(self, observation: Observation) -> np.ndarray:
+        return get_observation_vectors([observation])[0]
+
+    # Same result as get_n_most_similar_observations, subset is one of 'all', 'terms' or 'na'.
+    def get_n_most_similar_observations(self, observation: Observation, n: int = 10, subset: str = 'all',
+                                        use_bodyloc: bool = True, query_vector: np.ndarray = None) -> Dataset:
+        bodyloc = observation.bodyloc if use_bodyloc else None
+        if (bodyloc, subset) not in self.partitions:
+            return Dataset([])
+        partition = self.partitions[(bodyloc, subset)]
+        rows = self.rows[partition]
+
+        # If n is too large (not enough samples), readjust
+        n = min(n, len(rows))
+        if n == 0:
+            return Dataset([])
+
+        if query_vector is None:
+            query_vector = self.get_query_vector(observation)
+        scores = self.vectors[partition] @ query_vector
+
+        # Like spacy, identical texts are fully similar even without vectors
+        if observation.text in self.text_rows:
+            identical_rows = np.array(self.text_rows[observation.text], dtype=np.int64)
+            if isinstance(partition, slice):
+                identical_rows = identical_rows[(identical_rows >= partition.start) & (identical_rows < partition.stop)]
+                scores[identical_rows - partition.start] = 1
+            else:
+                scores[np.isin(partition, identical_rows)] = 1
+
+        # Keep everything tied with the n-th best score, then break ties by dataset order like a stable sort
+        if n < len(scores):
+            kth_score = scores[np.argpartition(-scores, n - 1)[n - 1]]
+            candidates = np.flatnonzero(scores >= kth_score)
+        else:
+            candidates = np.arange(len(scores))
+        candidates = candidates[np.lexsort((rows[candidates], -scores[candidates]))][:n]
+
+        return Dataset([self.dataset.observations[index] for index in rows[candidates]])
+
+    def save(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, 'vectors.npy'), self.vectors)
+        np.save(os.path.join(directory, 'rows.npy'), self.rows)
+        with open(os.path.join(directory, 'index.json'), 'w') as file:
+            json.dump({'fingerprint': self.fingerprint}, file)
+
+    # Vectors are memory-mapped, returns None if the saved index doesn't belong to the dataset.
+    @staticmethod
+    def load(directory: str, dataset: Dataset) -> 'SimilarityIndex':
+        try:
+            with open(os.path.join(directory, 'index.json'), 'r') as file:
+                fingerprint = json.load(file)['fingerprint']
+            if fingerprint != get_dataset_fingerprint(dataset):
+                return None
+            vectors = np.load(os.path.join(directory, 'vectors.npy'), mmap_mode='r')
+            rows = np.load(os.path.join(directory, 'rows.npy'))
+        except (OSError, ValueError, KeyError):
+            return None
+        return SimilarityIndex(dataset, vectors, rows)
+
+similarity_indexes = {}
+
+# Loads the index for the dataset from disk, builds and saves it if there is none.
+def get_similarity_index(dataset: Dataset, directory: str = SIMILARITY_INDEX_DIR) -> SimilarityIndex:
+    fingerprint = get_dataset_fingerprint(dataset)
+    if fingerprint in similarity_indexes and similarity_indexes[fingerprint].dataset is dataset:
+        return similarity_indexes[fingerprint]
+
+    index_directory = os.path.join(directory, fingerprint[:16])
+    similarity_index = SimilarityIndex.load(index_directory, dataset)
+    if similarity_index is None:
+        print('Building similarity index for %d observations...' % len(dataset.observations))
+        similarity_index = SimilarityIndex(dataset)
+        similarity_index.save(index_directory)
+    similarity_indexes[fingerprint] = similarity_index
+    return similarity_index
\ No newline at end of file
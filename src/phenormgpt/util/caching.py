@@ -1,14 +1,27 @@
 import os
 import json
 import pickle
+import sqlite3
+import threading
+import time
 from config.config import CACHE_DIR
 
-os.makedirs(CACHE_DIR, exist_ok=True)
+# Cache directory is created on first write, not on import
+def get_cache_filepath(filename: str) -> str:
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    return os.path.join(CACHE_DIR, filename)
 
+# Written to a temporary file first, so readers in other processes never see a partial pickle
 def save_to_cache(filename: str, object):
-    filepath = os.path.join(CACHE_DIR, filename)
-    with open(filepath, 'wb') as file:
-        pickle.dump(object, file)
+    filepath = get_cache_filepath(filename)
+    temp_filepath = '%s.%d-%d.tmp' % (filepath, os.getpid(), threading.get_ident())
+    try:
+        with open(temp_filepath, 'wb') as file:
+            pickle.dump(object, file)
+        os.replace(temp_filepath, filepath)
+    except BaseException:
+        os.remove(temp_filepath)
+        raise
 
 def load_from_cache(filename: str):
     filepath = os.path.join(CACHE_DIR, filename)
@@ -17,7 +30,7 @@ def load_from_cache(filename: str):
     return object
 
 def save_json_to_cache(filename: str, object):
-    filepath = os.path.join(CACHE_DIR, filename)
+    filepath = get_cache_filepath(filename)
     with open(filepath, 'w') as file:
         json.dump(object , file)
 
@@ -25,4 +38,149 @@ def load_json_from_cache(filename: str):
     filepath = os.path.join(CACHE_DIR, filename)
     with open(filepath, 'r') as file:
         object = json.load(file)
-    return object
\ No newline at end of file
+    return object
+
+# Persistent key-value store for strings, backed by SQLite.
+# Least recently used entries are evicted once values exceed max_size bytes.
+# A read-only cache never modifies the database, for reproducible runs.
+# Lookups don't write, access times of hits are kept in memory until the next write or close.
+class SQLiteCache:
+    def __init__(self, filepath: str, max_size: int = 1 << 30, read_only: bool = False):
+        self.filepath = filepath
+        self.max_size = max_size
+        self.read_only = read_only
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # Key -> access time not written to the database yet
+        self.accessed = {}
+
+        if read_only and not os.path.exists(filepath):
+            # Nothing cached yet, every lookup misses
+            print('Warning: Cache %s doesn\'t exist, reading from an empty cache.' % filepath)
+            self.connection = sqlite3.connect(':memory:', check_same_thread=False)
+            self.connection.execute('CREATE TABLE entries (key TEXT PRIMARY KEY, value TEXT, size INTEGER, accessed REAL)')
+        elif read_only:
+            self.connection = sqlite3.connect('file:%s?mode=ro' % filepath, uri=True, check_same_thread=False)
+        else:
+            directory = os.path.dirname(filepath)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.connection = sqlite3.connect(filepath, check_same_thread=False)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS entries '
+                                    '(key TEXT PRIMARY KEY, value TEXT, size INTEGER, accessed REAL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+            self.connection.commit()
+        self.size = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def get(self, key: str) -> str:
+        with self.lock:
+            row = self.connection.execute('SELECT value FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if not self.read_only:
+                self.accessed[key] = time.time()
+            return row[0]
+
+    def set(self, key: str, value: str):
+        if self.read_only:
+            return
+        size = len(value.encode('utf-8'))
+        with self.lock:
+            row = self.connection.execute('SELECT size FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                self.size -= row[0]
+            self.connection.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)', (key, value, size, time.time()))
+            self.size += size
+            self.accessed.pop(key, None)
+            self.write_accessed()
+            self.evict()
+            self.connection.commit()
+
+    # Looks up many keys in one transaction, returns key -> value for the keys found
+    def get_many(self, keys: list, batch_size: int = 500) -> dict:
+        values = {}
+        keys = list(dict.fromkeys(keys))
+        with self.lock:
+            for i in range(0, len(keys), batch_size):
+                batch = keys[i:i + batch_size]
+                rows = self.connection.execute('SELECT key, value FROM entries WHERE key IN (%s)' % \
+                                               ','.join(['?'] * len(batch)), batch).fetchall()
+                values.update(rows)
+            if not self.read_only:
+                accessed = time.time()
+                for key in values:
+                    self.accessed[key] = accessed
+            self.hits += len(values)
+            self.misses += len(keys) - len(values)
+        return values
+
+    # Stores many entries in one transaction
+    def set_many(self, items: dict):
+        if self.read_only or len(items) == 0:
+            return
+        with self.lock:
+            accessed = time.time()
+            for key, value in items.items():
+                size = len(value.encode('utf-8'))
+                row = self.connection.execute('SELECT size FROM entries WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    self.size -= row[0]
+                self.connection.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)', (key, value, size, accessed))
+                self.size += size
+                self.accessed.pop(key, None)
+            self.write_accessed()
+            self.evict()
+            self.connection.commit()
+
+    # Writes access times of hits, in the transaction of the next write. Expects the lock to be held.
+    def write_accessed(self):
+        if len(self.accessed) > 0:
+            self.connection.executemany('UPDATE entries SET accessed = ? WHERE key = ?',
+                                        [(accessed, key) for key, accessed in self.accessed.items()])
+            self.accessed.clear()
+
+    # Drops least recently used entries until the cache fits. Expects the lock to be held.
+    def evict(self):
+        while self.size > self.max_size:
+            rows = self.connection.execute('SELECT key, size FROM entries ORDER BY accessed LIMIT 100').fetchall()
+            if len(rows) == 0:
+                self.size = 0
+                break
+            for key, size in rows:
+                if self.size <= self.max_size:
+                    break
+                self.connection.execute('DELETE FROM entries WHERE key = ?', (key,))
+                self.size -= size
+
+    def clear(self):
+        if self.read_only:
+            return
+        with self.lock:
+            self.connection.execute('DELETE FROM entries')
+            self.connection.commit()
+            self.accessed.clear()
+            self.size = 0
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    def get_stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / requests if requests > 0 else 0.0,
+            'entries': len(self),
+            'size': self.size
+        }
+
+    def close(self):
+        with self.lock:
+            if not self.read_only and len(self.accessed) > 0:
+                self.write_accessed()
+                self.connection.commit()
+            self.connection.close()
\ No newline at end of file
@@ -0,0 +1,27 @@
+import threading
+
+# Module level singleton, loaded on first access instead of on import.
+# Thread-safe: concurrent callers wait for a single load.
+class LazyValue:
+    def __init__(self, loader):
+        self.loader = loader
+        self.lock = threading.RLock()
+        self.loaded = False
+        self.value = None
+
+    def get(self):
+        if not self.loaded:
+            with self.lock:
+                if not self.loaded:
+                    self.value = self.loader()
+                    self.loaded = True
+        return self.value
+
+    def is_loaded(self) -> bool:
+        return self.loaded
+
+    # Drops the value, next access loads it again
+    def reset(self):
+        with self.lock:
+            self.loaded = False
+            self.value = None
@@ -1,5 +1,9 @@
+import os
 import re
 import string
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import List
 from nltk import word_tokenize
 from nltk.stem.snowball import SnowballStemmer
 
@@ -30,32 +34,109 @@ PUNCTS.extend(list('±–’«»‘‚‛‘’‚‛′‵“”„‟‹›;·
 NOISE = '(?:\\b(?:%s|[0-9]+)\\b|%s|\\s+)' % ('|'.join(STOP_WORDS), PUNCT)
 RE_NOISE = re.compile(NOISE, re.I)
 
+STOP_WORD_SET = frozenset(STOP_WORDS)
+PUNCT_SET = frozenset(PUNCTS)
+
+# Text made of word characters and whitespace only, which is what's left after cleaning.
+# word_tokenize splits such text on whitespace, except for a few contractions without apostrophes.
+RE_SIMPLE_TEXT = re.compile(r'[\w\s]*')
+CONTRACTIONS = frozenset(['cannot', 'gimme', 'gonna', 'gotta', 'lemme', 'wanna'])
+
 stemmer = SnowballStemmer(language='english')
 
 smart_case = str.lower
 
-def stem(term, sort=False, lower=False, clean=False, stop_words=False):
+def tokenize(term: str) -> list:
+    if not RE_SIMPLE_TEXT.fullmatch(term):
+        return word_tokenize(term)
+
+    tokens = []
+    for token in term.split():
+        if smart_case(token) in CONTRACTIONS:
+            tokens.extend([token[:3], token[3:]])
+        else:
+            tokens.append(token)
+    return tokens
 
-    if clean:
-        term = RE_PUNCT.sub(' ', term).strip()
+# Stems terms with two LRU caches, one for whole terms (per flag combination) and one for tokens.
+# The same terms and words recur across HPO synonyms and predictions.
+class StemmingEngine:
+    def __init__(self, term_cache_size: int = 2 ** 18, token_cache_size: int = 2 ** 16):
+        self.stem_term = lru_cache(maxsize=term_cache_size)(self.stem_uncached)
+        self.stem_token = lru_cache(maxsize=token_cache_size)(stemmer.stem)
 
-    if lower:
-        term = smart_case(term)
+    def stem_uncached(self, term, sort=False, lower=False, clean=False, stop_words=False):
 
-    tokens = word_tokenize(term)
+        if clean:
+            term = RE_PUNCT.sub(' ', term).strip()
 
-    if stop_words:
         if lower:
-            tokens = [token for token in tokens if token not in STOP_WORDS]
-        else:
-            tokens = [token for token in tokens if smart_case(token) not in STOP_WORDS]
+            term = smart_case(term)
+
+        tokens = tokenize(term)
+
+        if stop_words:
+            if lower:
+                tokens = [token for token in tokens if token not in STOP_WORD_SET]
+            else:
+                tokens = [token for token in tokens if smart_case(token) not in STOP_WORD_SET]
+
+        nterm = [self.stem_token(token) for token in tokens if token not in PUNCT_SET]
+
+        if sort:
+            nterm = [smart_case(w) for w in nterm]
+            nterm.sort()
+
+        term = ' '.join(nterm)
+
+        return term
+
+    def get_cache_stats(self) -> dict:
+        stats = {}
+        for name, cache_info in [('term', self.stem_term.cache_info()), ('token', self.stem_token.cache_info())]:
+            requests = cache_info.hits + cache_info.misses
+            stats[name] = {
+                'hits': cache_info.hits,
+                'misses': cache_info.misses,
+                'size': cache_info.currsize,
+                'hit_rate': cache_info.hits / requests if requests > 0 else 0.0
+            }
+        return stats
+
+    def print_cache_stats(self):
+        for name, stats in self.get_cache_stats().items():
+            print('Stemming %s cache: %d hits, %d misses (%.1f%% hit rate), %d entries.' % \
+                  (name, stats['hits'], stats['misses'], 100 * stats['hit_rate'], stats['size']))
+
+    def clear_cache(self):
+        self.stem_term.cache_clear()
+        self.stem_token.cache_clear()
+
+stemming_engine = StemmingEngine()
+
+def stem(term, sort=False, lower=False, clean=False, stop_words=False):
+    # Positional arguments, so every call with the same flags shares a cache key
+    return stemming_engine.stem_term(term, sort, lower, clean, stop_words)
 
-    nterm = [stemmer.stem(token) for token in tokens if token not in PUNCTS]
+def stem_chunk(terms: List[str], sort: bool, lower: bool, clean: bool, stop_words: bool) -> List[str]:
+    return [stem(term, sort, lower, clean, stop_words) for term in terms]
 
-    if sort:
-        nterm = [smart_case(w) for w in nterm]
-        nterm.sort()
+# Bulk stemming, results are in input order. Unique terms are stemmed once,
+# in chunks across a process pool when there are enough of them.
+def stem_many(terms: List[str], sort=False, lower=False, clean=False, stop_words=False,
+              workers: int = None, chunk_size: int = 2000) -> List[str]:
+    unique_terms = list(dict.fromkeys(terms))
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, -(-len(unique_terms) // chunk_size))
 
-    term = ' '.join(nterm)
+    if workers <= 1:
+        stemmed_terms = stem_chunk(unique_terms, sort, lower, clean, stop_words)
+    else:
+        chunks = [unique_terms[i:i + chunk_size] for i in range(0, len(unique_terms), chunk_size)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            stemmed_chunks = executor.map(stem_chunk, chunks, *[[flag] * len(chunks) for flag in [sort, lower, clean, stop_words]])
+            stemmed_terms = [stemmed_term for stemmed_chunk in stemmed_chunks for stemmed_term in stemmed_chunk]
 
-    return term
\ No newline at end of file
+    stemmed_dict = dict(zip(unique_terms, stemmed_terms))
+    return [stemmed_dict[term] for term in terms]
\ No newline at end of file
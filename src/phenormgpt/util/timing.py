@@ -0,0 +1,36 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# Accumulates wall clock time per named stage, for timing summaries.
+# Stages can be measured many times, also from several threads at once.
+class StageTimer:
+    def __init__(self):
+        # Stage name -> [seconds, count], in order of first measurement
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def add(self, name: str, seconds: float, count: int = 1):
+        with self.lock:
+            stage = self.stages.setdefault(name, [0.0, 0])
+            stage[0] += seconds
+            stage[1] += count
+
+    @contextmanager
+    def measure(self, name: str):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start_time)
+
+    def get_summary(self) -> dict:
+        with self.lock:
+            return {name: {'seconds': seconds, 'count': count} for name, (seconds, count) in self.stages.items()}
+
+    # Time of concurrent stages adds up over threads, so it can exceed the total
+    def print_summary(self):
+        print('Stage\tCount\tSeconds\tMean (ms)')
+        for name, stage in self.get_summary().items():
+            print('%s\t%d\t%.2f\t%.2f' % (name, stage['count'], stage['seconds'],
+                                          1000 * stage['seconds'] / max(stage['count'], 1)))
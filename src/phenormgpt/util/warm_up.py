@@ -0,0 +1,36 @@
+# Explicitly load the lazy singletons ahead of time, e.g. before forking workers
+# or serving requests, instead of paying for them on first use.
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from matching.lexicon import get_lexicon
+from prompting.openai_dataset_analysis import get_encoding
+from prompting.similarity import get_model
+
+def warm_up(lexicon: bool = True, model: bool = False, encoding: bool = False,
+            parallel: bool = True, debug: bool = True) -> dict:
+    loaders = {}
+    if lexicon:
+        loaders['lexicon'] = get_lexicon
+    if model:
+        loaders['model'] = get_model
+    if encoding:
+        loaders['encoding'] = get_encoding
+
+    def load(name: str) -> float:
+        start_time = time.time()
+        loaders[name]()
+        return time.time() - start_time
+
+    # Loaders are independent, so they can overlap
+    if parallel and len(loaders) > 1:
+        with ThreadPoolExecutor(max_workers=len(loaders)) as executor:
+            durations = dict(zip(loaders.keys(), executor.map(load, loaders.keys())))
+    else:
+        durations = {name: load(name) for name in loaders.keys()}
+
+    if debug:
+        for name, duration in durations.items():
+            print('Loaded %s in %.2f seconds.' % (name, duration))
+    return durations